@@ -1,9 +1,19 @@
+import asyncio
 import calendar
+import hashlib
+import http.server
 import itertools
-from typing import Any
+import os
+import threading
+import time
+import types
+from typing import Any, Iterator
 
+import numpy as np
 import pandas as pd
 import pytest
+import requests
+import xarray as xr
 
 from xarray_ecmwf import client_common
 
@@ -101,9 +111,14 @@ def test_build_chunk_ymd_requests(
     assert time_chunk == 24
     assert len(time_chunk_requests) == total_days
 
-    request_chunks = {"day": 45}
+    for request_chunks in [{"day": 7}, {"month": 5}, {"year": 2}]:
+        res = client_common.build_chunk_ymd_requests(request, request_chunks)
+        assert isinstance(res[1], tuple)
+        assert sum(res[1]) == len(res[0]) == len(time)
+        assert [start for start, _ in res[2]] == [0, *itertools.accumulate(res[1])][:-1]
+
     with pytest.raises(ValueError):
-        client_common.build_chunk_ymd_requests(request, request_chunks)
+        client_common.build_chunk_ymd_requests(request, {"day": 0})
 
 
 def test_build_chunk_request() -> None:
@@ -130,3 +145,485 @@ def test_build_chunk_request() -> None:
     assert chunk == 6
     assert chunk_request[0][0] == 0
     assert chunk_request[0][1] == {"x": ["a", "b", "c", "d", "e", "f"]}
+
+
+def test_canonical_request() -> None:
+    request = {
+        "variable": ["2m_temperature", "10m_u_component_of_wind"],
+        "year": "2022",
+        "month": ["1", "02"],
+        "time": ["12:00", "00:00"],
+        "area": [90, 0, -90, 180.0],
+        "download_format": "unarchived",
+    }
+    expected = {
+        "area": ["90", "0", "-90", "180"],
+        "month": ["1", "2"],
+        "time": ["0", "1200"],
+        "variable": ["10m_u_component_of_wind", "2m_temperature"],
+        "year": ["2022"],
+    }
+
+    res = client_common.canonical_request(request)
+
+    assert res == expected
+    assert list(res) == sorted(expected)
+
+    equivalent_request = {
+        "time": ["0", "12"],
+        "month": [2, 1],
+        "year": 2022,
+        "area": ["90", "0", "-90", "180"],
+        "variable": ["10m_u_component_of_wind", "2m_temperature"],
+    }
+    assert client_common.request_hash(request) == client_common.request_hash(
+        equivalent_request
+    )
+    assert client_common.request_hash(request) != client_common.request_hash(
+        equivalent_request | {"area": ["0", "90", "-90", "180"]}
+    )
+
+
+def test_request_covers() -> None:
+    superset = client_common.canonical_request(
+        {"variable": "2t", "date": "2022-01-01/2022-01-31", "time": ["00:00", "12:00"]}
+    )
+
+    for request, expected in [
+        ({"variable": "2t", "date": "2022-01-05", "time": "12"}, True),
+        ({"variable": "2t", "date": "2022-01-30/2022-01-31", "time": "0"}, True),
+        ({"variable": "2t", "date": "2022-01-31/2022-02-01", "time": "0"}, False),
+        ({"variable": "2t", "date": "2022-01-05", "time": "06:00"}, False),
+        ({"variable": "tp", "date": "2022-01-05", "time": "12"}, False),
+        ({"date": "2022-01-05", "time": "12"}, False),
+    ]:
+        canonical = client_common.canonical_request(request)
+        assert client_common.request_covers(superset, canonical) == expected
+
+
+def test_subset_dataset_invalid_days() -> None:
+    time = pd.date_range("2021-01-01", "2021-03-31T12:00", freq="12h")
+    ds = xr.Dataset({"t2m": ("time", np.arange(time.size))}, coords={"time": time})
+    request = {
+        "year": "2021",
+        "month": "02",
+        "day": [f"{day:02}" for day in range(1, 32)],
+        "time": "12:00",
+    }
+
+    res = client_common.subset_dataset(ds, request)
+
+    assert res is not None
+    expected = pd.date_range("2021-02-01T12:00", "2021-02-28T12:00", freq="D")
+    np.testing.assert_array_equal(res.time, expected)
+
+
+def test_build_time_chunk_requests_invalid_days() -> None:
+    request = {
+        "year": ["2021"],
+        "month": ["02", "04"],
+        "day": ["01", "29", "30", "15"],
+        "time": ["00:00", "12:30"],
+    }
+    expected_dates = [
+        "2021-02-01",
+        "2021-04-01",
+        "2021-04-29",
+        "2021-04-30",
+        "2021-04-15",
+    ]
+    expected = pd.to_datetime(
+        [f"{d}T{t}" for d in expected_dates for t in request["time"]]
+    ).values
+
+    time, time_chunk, time_chunk_requests = client_common.build_time_chunk_requests(
+        request, {"month": 1}
+    )
+
+    np.testing.assert_array_equal(time, expected)
+    assert time_chunk == (2, 8)
+    assert time_chunk_requests == [
+        (0, {"year": "2021", "month": "02", "day": ["01"]}),
+        (2, {"year": "2021", "month": "04", "day": ["01", "29", "30", "15"]}),
+    ]
+
+    time, time_chunk, time_chunk_requests = client_common.build_time_chunk_requests(
+        request, {"day": 1}
+    )
+
+    # the days of a month after an invalid one are kept only when chunking by day
+    assert time.size == 2 * 6
+    assert time[-2:].astype(str).tolist() == [
+        "2021-04-15T00:00:00.000000000",
+        "2021-04-15T12:30:00.000000000",
+    ]
+    assert time_chunk == 2
+    assert [start for start, _ in time_chunk_requests] == list(range(0, 12, 2))
+    assert time_chunk_requests[1] == (2, {"year": "2021", "month": "02", "day": "15"})
+
+
+@pytest.mark.parametrize("request_chunks", [{}, {"day": 1}, {"month": 1}])
+def test_build_time_chunk_requests_large(request_chunks: dict[str, int]) -> None:
+    request = {
+        "year": [str(year) for year in range(1940, 2060)],
+        "month": ALL_MONTHS,
+        "day": ALL_DAYS,
+        "time": ALL_TIMES,
+    }
+
+    time, _, _ = client_common.build_time_chunk_requests(request, request_chunks)
+
+    expected = pd.date_range("1940-01-01", "2059-12-31T23:00", freq="h").values
+    np.testing.assert_array_equal(time, expected)
+
+    request = {"date": ["1940-01-01/2059-12-31"], "time": ALL_TIMES}
+    time, _, _ = client_common.build_time_chunk_requests(request, {"day": 10})
+
+    np.testing.assert_array_equal(time, expected)
+
+
+def test_chunk_plan() -> None:
+    _, _, chunk_requests = client_common.build_chunk_date_requests(
+        {"date": ["2023-06-01/2023-06-10"], "time": ["00:00", "12:00"]}, {"day": 4}
+    )
+
+    chunk_plan = client_common.ChunkPlan.from_chunk_requests(chunk_requests, 20)
+
+    assert len(chunk_plan) == 3
+    np.testing.assert_array_equal(chunk_plan.starts, [0, 8, 16])
+    np.testing.assert_array_equal(chunk_plan.sizes, [8, 8, 4])
+    assert chunk_plan.fragments[2] == {"date": "2023-06-09/2023-06-10"}
+    np.testing.assert_array_equal(
+        chunk_plan.find_chunks(np.array([0, 7, 8, 15, 16, 19])), [0, 0, 1, 1, 2, 2]
+    )
+    assert chunk_plan.find_chunks(9) == 1
+    with pytest.raises(ValueError):
+        chunk_plan.starts[0] = 1
+
+
+def test_build_chunk_ymd_requests_n_months_and_years() -> None:
+    request = {
+        "year": ["2019", "2020", "2021"],
+        "month": ["01", "02", "03"],
+        "day": ["01", "29", "30"],
+        "time": ["00:00", "12:00"],
+    }
+
+    _, time_chunk, time_chunk_requests = client_common.build_chunk_ymd_requests(
+        request, {"month": 2}
+    )
+
+    assert time_chunk == (8, 6, 10, 6, 8, 6)
+    assert time_chunk_requests[:3] == [
+        (0, {"year": "2019", "month": ["01", "02"], "day": ["01", "29", "30"]}),
+        (8, {"year": "2019", "month": ["03"], "day": ["01", "29", "30"]}),
+        (14, {"year": "2020", "month": ["01", "02"], "day": ["01", "29", "30"]}),
+    ]
+
+    _, time_chunk, time_chunk_requests = client_common.build_chunk_ymd_requests(
+        request, {"year": 2}
+    )
+
+    assert time_chunk == (30, 14)
+    assert time_chunk_requests[1] == (
+        30,
+        {"year": ["2021"], "month": ["01", "02", "03"], "day": ["01", "29", "30"]},
+    )
+
+    _, time_chunk, time_chunk_requests = client_common.build_chunk_ymd_requests(
+        request, {"day": 2}
+    )
+
+    assert isinstance(time_chunk, tuple)
+    assert time_chunk[:3] == (4, 2, 2)
+    assert time_chunk_requests[1] == (
+        4,
+        {"year": "2019", "month": "01", "day": ["30"]},
+    )
+
+
+@pytest.mark.parametrize(
+    "request_chunks, expected_dates, expected_chunk",
+    [
+        ({"day": 30}, ["2023-11-20/2023-12-19", "2023-12-20/2024-01-18"], 60),
+        (
+            {"month": 1},
+            ["2023-11-20/2023-11-30", "2023-12-01/2023-12-31"],
+            (22, 62, 62, 58, 20),
+        ),
+        (
+            {"month": 2},
+            ["2023-11-20/2023-12-31", "2024-01-01/2024-02-29"],
+            (84, 120, 20),
+        ),
+        ({"year": 1}, ["2023-11-20/2023-12-31", "2024-01-01/2024-03-10"], (84, 140)),
+    ],
+)
+def test_build_chunk_date_requests_n_months_and_years(
+    request_chunks: dict[str, int],
+    expected_dates: list[str],
+    expected_chunk: int | tuple[int, ...],
+) -> None:
+    request = {"date": ["2023-11-20/2024-03-10"], "time": ["00:00", "12:00"]}
+
+    time, time_chunk, time_chunk_requests = client_common.build_chunk_date_requests(
+        request, request_chunks
+    )
+
+    assert time.size == 2 * 112
+    assert time_chunk == expected_chunk
+    assert [r["date"] for _, r in time_chunk_requests[:2]] == expected_dates
+    if isinstance(time_chunk, tuple):
+        assert sum(time_chunk) == time.size
+
+
+def test_split_request() -> None:
+    request = {
+        "variable": ["2t"],
+        "date": ["2023-01-01/2023-01-05"],
+        "time": ["00:00", "12:00"],
+        "number": ["0", "1", "2"],
+    }
+
+    res = client_common.split_request(request)
+
+    assert res == (
+        "time",
+        [
+            request | {"date": ["2023-01-01/2023-01-02"]},
+            request | {"date": ["2023-01-03/2023-01-05"]},
+        ],
+    )
+
+    res = client_common.split_request(request | {"number": [str(n) for n in range(6)]})
+
+    assert res is not None
+    assert res[0] == "number"
+    assert [r["number"] for r in res[1]] == [["0", "1", "2"], ["3", "4", "5"]]
+
+    request = request | {"date": ["2023-01-01/2023-01-01"], "number": ["0"]}
+    assert client_common.split_request(request) is None
+
+
+def test_coalesce_requests() -> None:
+    requests = [
+        {"date": ["2023-01-03/2023-01-04"], "time": "00:00"},
+        {"date": ["2023-01-01/2023-01-02"], "time": "00:00"},
+        {"date": ["2023-01-05/2023-01-06"], "time": "00:00"},
+        {"date": ["2023-01-01/2023-01-02"], "time": "12:00"},
+        {"date": ["2023-01-09/2023-01-09"], "time": "00:00"},
+    ]
+
+    res = client_common.coalesce_requests(requests, max_requests=4)
+
+    assert res == [
+        ({"date": ["2023-01-01/2023-01-02"], "time": ["00:00", "12:00"]}, [1, 3]),
+        ({"date": ["2023-01-03/2023-01-06"], "time": "00:00"}, [0, 2]),
+        ({"date": ["2023-01-09/2023-01-09"], "time": "00:00"}, [4]),
+    ]
+
+
+def test_adaptive_limiter() -> None:
+    limiter = client_common.AdaptiveLimiter(limit=2, max_limit=3)
+
+    assert limiter.try_acquire()
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+
+    # additive increase of about 1 per round of successes
+    limiter.release()
+    limiter.release()
+    assert limiter.limit == pytest.approx(2 + 1 / 2 + 1 / 2.5)
+
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.limit == 3
+
+    # multiplicative decrease on throttling, other errors leave the limit alone
+    limiter.acquire()
+    limiter.release(client_common.RequestThrottledError())
+    assert limiter.limit == 1.5
+    limiter.acquire()
+    limiter.release(RuntimeError("request failed"))
+    assert limiter.limit == 1.5
+    limiter.acquire()
+    limiter.release(RuntimeError("429 Client Error: Too Many Requests"))
+    limiter.acquire()
+    limiter.release(RuntimeError("429 Client Error: Too Many Requests"))
+    assert limiter.limit == 1
+    assert limiter.active == 0
+
+
+def test_adaptive_limiter_acquire_async() -> None:
+    limiter = client_common.AdaptiveLimiter(limit=1)
+    limiter.acquire()
+
+    async def acquire() -> float:
+        await limiter.acquire_async()
+        return time.perf_counter()
+
+    timer = threading.Timer(0.2, limiter.release)
+    timer.start()
+    start = time.perf_counter()
+    acquired = asyncio.run(acquire())
+
+    assert acquired - start >= 0.2
+    assert limiter.active == 1
+
+
+def test_is_throttling_error() -> None:
+    class HTTPError(Exception):
+        response = types.SimpleNamespace(status_code=429)
+
+    assert client_common.is_throttling_error(HTTPError("Client Error"))
+    assert client_common.is_throttling_error(client_common.RequestThrottledError())
+    assert client_common.is_throttling_error(RuntimeError("rate limit exceeded"))
+    assert not client_common.is_throttling_error(RuntimeError("request failed"))
+    message = "checksum mismatch 4f29a0b429e1 of https://example.com/4291.grib"
+    assert not client_common.is_throttling_error(RuntimeError(message))
+
+
+def test_client_pool() -> None:
+    created = []
+
+    def factory(**kwargs: Any) -> dict[str, Any]:
+        created.append(kwargs)
+        return {"kwargs": kwargs}
+
+    client_pool = client_common.ClientPool(factory, max_idle=1)
+    kwargs = {"url": "https://cds", "headers": {"a": "b"}}
+
+    with client_pool.client(**kwargs) as client:
+        pass
+    with client_pool.client(**kwargs) as res:
+        assert res is client
+        # a client is never shared by two users at the same time
+        with client_pool.client(**kwargs) as other:
+            assert other is not client
+    with client_pool.client(url="https://other") as res:
+        assert res is not client
+    assert len(created) == 3
+
+    # only `max_idle` clients are kept and the ones that raised are dropped
+    with pytest.raises(RuntimeError):
+        with client_pool.client(**kwargs) as res:
+            assert res is other
+            raise RuntimeError("broken session")
+    with client_pool.client(**kwargs) as res:
+        assert res is not other
+    assert len(created) == 4
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    data = bytes(range(256)) * 64
+    # number of bytes sent before dropping the connection, by request
+    drops: list[int] = []
+    ranges: list[str | None] = []
+    support_ranges = True
+    # HTTP error status codes to reply with, by request
+    errors: list[int] = []
+
+    def do_GET(self) -> None:
+        range_header = self.headers.get("Range")
+        self.ranges.append(range_header)
+        if self.errors:
+            self.send_error(self.errors.pop(0))
+            return
+        start = 0
+        if range_header is not None and self.support_ranges:
+            start = int(range_header.removeprefix("bytes=").removesuffix("-"))
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(self.data) - start))
+        self.end_headers()
+        stop = start + self.drops.pop(0) if self.drops else len(self.data)
+        self.wfile.write(self.data[start:stop])
+        self.close_connection = True
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+
+@pytest.fixture
+def flaky_server() -> Iterator[http.server.ThreadingHTTPServer]:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    FlakyHandler.drops = []
+    FlakyHandler.ranges = []
+    FlakyHandler.support_ranges = True
+    FlakyHandler.errors = []
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_download_with_resume(
+    tmp_path: Any, flaky_server: http.server.ThreadingHTTPServer, support_ranges: bool
+) -> None:
+    url = f"http://127.0.0.1:{flaky_server.server_port}/result.grib"
+    target = str(tmp_path / "result.grib")
+    data = FlakyHandler.data
+    checksum = ("md5", hashlib.md5(data).hexdigest())
+    FlakyHandler.support_ranges = support_ranges
+    FlakyHandler.drops = [1000, 5000]
+
+    res = client_common.download_with_resume(
+        url, target, len(data), checksum, retry_after=0, chunk_size=100
+    )
+
+    assert res == target
+    with open(target, "rb") as f:
+        assert f.read() == data
+    assert os.listdir(tmp_path) == ["result.grib"]
+    if support_ranges:
+        assert FlakyHandler.ranges == [None, "bytes=1000-", "bytes=6000-"]
+    else:
+        assert len(FlakyHandler.ranges) == 3
+
+
+def test_download_with_resume_errors(
+    tmp_path: Any, flaky_server: http.server.ThreadingHTTPServer
+) -> None:
+    url = f"http://127.0.0.1:{flaky_server.server_port}/result.grib"
+    target = str(tmp_path / "result.grib")
+    data = FlakyHandler.data
+
+    # the partial file is kept when the retries are exhausted
+    FlakyHandler.drops = [1000, 0, 0]
+    with pytest.raises(Exception):
+        client_common.download_with_resume(
+            url, target, max_retries=1, retry_after=0, chunk_size=100
+        )
+    [partial] = os.listdir(tmp_path)
+    assert os.path.getsize(tmp_path / partial) == 1000
+
+    # and resumed by the next attempt
+    FlakyHandler.ranges = []
+    checksum = ("md5", "0" * 32)
+    with pytest.raises(RuntimeError, match="checksum"):
+        client_common.download_with_resume(
+            url, target, len(data), checksum, retry_after=0, chunk_size=100
+        )
+    assert FlakyHandler.ranges == ["bytes=1000-"]
+    assert os.listdir(tmp_path) == []
+
+    # the partial file is removed on the errors that are not interruptions
+    FlakyHandler.drops = [1000, 0]
+    with pytest.raises(Exception):
+        client_common.download_with_resume(
+            url, target, max_retries=0, retry_after=0, chunk_size=100
+        )
+    assert len(os.listdir(tmp_path)) == 1
+
+    FlakyHandler.errors = [403]
+    with pytest.raises(requests.HTTPError):
+        client_common.download_with_resume(url, target, retry_after=0)
+    assert os.listdir(tmp_path) == []
+
+
+def test_parse_multihash() -> None:
+    md5 = hashlib.md5(b"").hexdigest()
+    assert client_common.parse_multihash("d50110" + md5) == ("md5", md5)
+    assert client_common.parse_multihash("ff" + md5) is None
+    assert client_common.parse_multihash(None) is None
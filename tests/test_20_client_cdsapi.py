@@ -0,0 +1,250 @@
+import contextlib
+from typing import Any, Callable, Iterator, cast
+
+import numpy as np
+import pytest
+import xarray as xr
+from xarray.core import indexing
+
+from xarray_ecmwf import client_cdsapi, client_common, engine_ecmwf
+
+REQUEST = {
+    "dataset": "reanalysis-era5-single-levels",
+    "variable": ["2m_temperature"],
+    "year": ["2022"],
+    "month": ["01", "02"],
+    "day": ["01", "02", "03"],
+    "time": ["00:00", "12:00"],
+}
+
+
+VARIABLES = {"2m_temperature": ("t2m", 167), "total_precipitation": ("tp", 228)}
+
+
+def make_dataset(request: dict[str, Any]) -> xr.Dataset:
+    request = {k: v if isinstance(v, list) else [v] for k, v in request.items()}
+    time = client_common.build_ymd_coordinates_request(request)
+    data = time.astype("datetime64[h]").astype("float32")[:, None] + np.arange(3)
+    data_vars = {}
+    for variable in request["variable"]:
+        name, param_id = VARIABLES[variable]
+        attrs = {"GRIB_paramId": param_id}
+        data_vars[name] = (("time", "values"), data + param_id, attrs)
+    return xr.Dataset(data_vars, coords={"time": time})
+
+
+class DummyDatasetCacher:
+    def __init__(self) -> None:
+        self.requests: list[dict[str, Any]] = []
+        self.sample_requests: list[dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def retrieve(
+        self, request: dict[str, Any], override_cache_file: bool | None = None
+    ) -> Iterator[xr.Dataset]:
+        self.requests.append(request)
+        yield make_dataset(request)
+
+    def retrieve_values(
+        self,
+        request: dict[str, Any],
+        name: str,
+        selector: Callable[[xr.Dataset], xr.DataArray],
+        selection: dict[str, Any],
+    ) -> Any:
+        with self.retrieve(request) as ds:
+            return selector(ds).isel(selection).values
+
+    def prefetch(self, requests: list[dict[str, Any]]) -> None:
+        pass
+
+    @contextlib.contextmanager
+    def cached_empty_dataset(self, request: dict[str, Any]) -> Iterator[xr.Dataset]:
+        self.sample_requests.append(request)
+        yield make_dataset(request)
+
+
+@pytest.mark.parametrize(
+    "key, expected_requests",
+    [
+        ((slice(None), slice(None)), 6),
+        ((slice(1, 5), slice(None)), 3),
+        ((slice(0, 12, 5), slice(0, 2)), 3),
+        ((slice(3, 4), 1), 1),
+        ((7, slice(None)), 1),
+        ((slice(4, 4), slice(None)), 0),
+        ((np.array([0, 5, 6, 11]), slice(None)), 4),
+        ((np.array([2, 3, 3]), slice(1, 2)), 1),
+    ],
+)
+def test_get_chunk_values(key: tuple[Any, ...], expected_requests: int) -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request_chunker = client_cdsapi.CdsapiRequestChunker(REQUEST, {"day": 1})
+    request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
+    expected = make_dataset(REQUEST).t2m.values[key]
+
+    res = request_chunker.get_chunk_values(key, dataset_cacher)
+
+    assert len(dataset_cacher.requests) == expected_requests
+    np.testing.assert_array_equal(res, expected)
+
+
+def test_get_chunk_values_outer_indexing() -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request_chunker = client_cdsapi.CdsapiRequestChunker(REQUEST, {"day": 1})
+    _, _, _, _, dtype = request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
+    backend_array = engine_ecmwf.ECMWFBackendArray(
+        (12, 3),
+        dtype,
+        cast(client_common.RequestChunkerProtocol, request_chunker),
+        dataset_cacher,
+    )
+    var = xr.Variable(("time", "values"), indexing.LazilyIndexedArray(backend_array))
+    expected = make_dataset(REQUEST).t2m.variable
+
+    res = var.isel(time=[11, 0, 1], values=[2, 0])
+
+    xr.testing.assert_equal(res, expected.isel(time=[11, 0, 1], values=[2, 0]))
+    assert len(dataset_cacher.requests) == 2
+
+
+@pytest.mark.parametrize("merge_variables", [True, False])
+def test_get_variables_coords_attrs_and_dtype(merge_variables: bool) -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request = REQUEST | {"variable": list(VARIABLES)}
+    request_chunker = client_cdsapi.CdsapiRequestChunker(
+        request, {"day": 1}, merge_variables=merge_variables
+    )
+    expected = make_dataset(request)
+
+    var_defs = request_chunker.get_variables_coords_attrs_and_dtype(dataset_cacher)
+
+    assert len(dataset_cacher.sample_requests) == (1 if merge_variables else 2)
+    assert [var_def[0] for _, var_def in var_defs] == ["t2m", "tp"]
+    for var_request_chunker, (name, coords, *_) in var_defs:
+        assert list(coords) == ["time", "values"]
+        key = (slice(None), slice(None))
+        res = var_request_chunker.get_chunk_values(key, dataset_cacher)
+        np.testing.assert_array_equal(res, expected[name].values)
+
+    field_requests = {str(request) for request in dataset_cacher.requests}
+    assert len(field_requests) == (6 if merge_variables else 12)
+
+    var_defs = request_chunker.get_variables_coords_attrs_and_dtype(
+        dataset_cacher, drop_variables=["total_precipitation"]
+    )
+
+    assert [var_def[0] for _, var_def in var_defs] == ["t2m"]
+
+
+@pytest.mark.parametrize("request_chunks", [{"day": 1}, {}])
+def test_get_coords_attrs_and_dtype_probe_sample(
+    request_chunks: dict[str, Any],
+) -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request_chunker = client_cdsapi.CdsapiRequestChunker(
+        REQUEST, request_chunks, probe_sample=True
+    )
+    expected = make_dataset(REQUEST)
+
+    _, coords, *_ = request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
+
+    assert dataset_cacher.sample_requests[0] == REQUEST | {
+        "month": ["01"],
+        "day": ["01"],
+        "time": ["00:00"],
+    }
+    assert coords["time"].equals(expected.time.variable.to_base_variable())
+    res = request_chunker.get_chunk_values((slice(None), slice(None)), dataset_cacher)
+    np.testing.assert_array_equal(res, expected.t2m.values)
+
+
+@pytest.mark.parametrize(
+    "request_chunks, expected_requests",
+    [({"day": 2}, 4), ({"month": 1}, 2), ({"month": 2}, 1), ({"year": 1}, 1)],
+)
+def test_get_chunk_values_n_chunks(
+    request_chunks: dict[str, int], expected_requests: int
+) -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request_chunker = client_cdsapi.CdsapiRequestChunker(REQUEST, request_chunks)
+    request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
+    expected = make_dataset(REQUEST).t2m.values
+
+    res = request_chunker.get_chunk_values((slice(None), slice(None)), dataset_cacher)
+
+    assert len(dataset_cacher.requests) == expected_requests
+    np.testing.assert_array_equal(res, expected)
+
+
+@pytest.mark.parametrize(
+    "kwargs, expected_request_chunks, expected_jobs",
+    [
+        ({}, {}, 1),
+        ({"target_chunk_bytes": 6 * 24}, {"month": 1}, 2),
+        ({"max_fields": 4}, {"day": 2}, 4),
+    ],
+)
+def test_request_chunks_auto(
+    kwargs: dict[str, Any],
+    expected_request_chunks: dict[str, int],
+    expected_jobs: int,
+) -> None:
+    dataset_cacher = DummyDatasetCacher()
+    request_chunker = client_cdsapi.CdsapiRequestChunker(REQUEST, "auto", **kwargs)
+    expected = make_dataset(REQUEST).t2m.values
+
+    request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
+
+    assert request_chunker.request_chunks == expected_request_chunks
+    assert request_chunker.chunk_cost["jobs"] == expected_jobs
+    res = request_chunker.get_chunk_values((slice(None), slice(None)), dataset_cacher)
+    assert len(dataset_cacher.requests) == expected_jobs
+    np.testing.assert_array_equal(res, expected)
+
+
+def test_choose_request_chunks() -> None:
+    request = REQUEST | {"pressure_level": [str(level) for level in range(10)]}
+    request_chunker = client_cdsapi.CdsapiRequestChunker(request, "auto", max_fields=5)
+
+    request_chunks, chunk_cost = request_chunker.choose_request_chunks(12, 1)
+
+    assert request_chunks == {"day": 1, "pressure_level": 2}
+    assert chunk_cost["jobs"] == 6 * 5
+    assert chunk_cost["fields"] == 4
+
+    # a day of 2 time steps exceeds the limit of 4 // 3 time steps
+    request = REQUEST | {"pressure_level": ["500", "850", "1000"]}
+    request_chunker = client_cdsapi.CdsapiRequestChunker(request, "auto", max_fields=4)
+
+    request_chunks, chunk_cost = request_chunker.choose_request_chunks(12, 1)
+
+    assert request_chunks == {"day": 1, "pressure_level": 2}
+    assert chunk_cost["jobs"] == 6 * 2
+    assert chunk_cost["fields"] == 4
+
+
+def test_cdsapi_request_client_reuses_clients(monkeypatch: Any) -> None:
+    created = []
+
+    class Client:
+        def __init__(self, **kwargs: Any) -> None:
+            created.append(kwargs)
+
+        def retrieve(self, dataset: str, request: dict[str, Any]) -> Any:
+            return (dataset, request)
+
+    monkeypatch.setattr(client_cdsapi, "CLIENT_POOL", client_common.ClientPool(Client))
+    request_client = client_cdsapi.CdsapiRequestClient({"quiet": True})
+    request = {"dataset": "reanalysis-era5-single-levels", "day": "01"}
+
+    for _ in range(3):
+        res = request_client.submit_and_wait_on_result(request)
+        assert res == ("reanalysis-era5-single-levels", {"day": "01", "format": "grib"})
+    request_client.submit(request)
+
+    expected = [
+        {"quiet": True, "wait_until_complete": True},
+        {"quiet": True, "wait_until_complete": False},
+    ]
+    assert created == expected
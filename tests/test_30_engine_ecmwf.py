@@ -0,0 +1,710 @@
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import shutil
+import threading
+import time
+import types
+from typing import Any
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from xarray_ecmwf import client_common, engine_ecmwf
+
+REQUEST = {
+    "dataset": "reanalysis-era5-single-levels",
+    "variable": ["2m_temperature"],
+    "year": ["2022"],
+    "month": ["01"],
+    "day": ["01", "02"],
+    "time": ["00:00", "12:00"],
+}
+
+
+class DummyRequestClient:
+    def __init__(self, client_kwargs: dict[str, Any] = {}) -> None:
+        self.submitted: list[dict[str, Any]] = []
+
+    def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+        self.submitted.append(request)
+        return request
+
+    def get_filename(self, result: Any) -> str:
+        return "dummy.grib"
+
+    def download(self, result: Any, target: str | None = None) -> str:
+        assert target is not None
+        request = {k: v if isinstance(v, list) else [v] for k, v in result.items()}
+        time = client_common.build_ymd_coordinates_request(request)
+        data = time.astype("datetime64[h]").astype("float32")[:, None] + np.arange(4)
+        ds = xr.Dataset({"t2m": (("time", "values"), data)}, coords={"time": time})
+        with open(target, "wb") as f:
+            pickle.dump(ds, f)
+        return target
+
+
+def open_pickle(path: str, **kwargs: Any) -> xr.Dataset:
+    with open(path, "rb") as f:
+        return pickle.load(f)  # type: ignore
+
+
+def test_dataset_cacher_retrieve_from_cache(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path)
+    )
+    request = REQUEST
+
+    with dataset_cacher.retrieve(request) as ds:
+        assert "t2m" in ds
+    with dataset_cacher.retrieve(request) as ds:
+        assert "t2m" in ds
+
+    assert len(request_client.submitted) == 1
+
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path), cache_only=True
+    )
+    with dataset_cacher.retrieve(request) as ds:
+        assert "t2m" in ds
+
+    with pytest.raises(FileNotFoundError):
+        with dataset_cacher.retrieve(request | {"day": ["03"]}):
+            pass
+
+    assert len(request_client.submitted) == 1
+
+
+def test_dataset_cacher_no_cache_file(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_file=False, cache_folder=str(tmp_path)
+    )
+    request = REQUEST
+
+    with dataset_cacher.retrieve(request) as ds:
+        assert "t2m" in ds.load()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_open_dataset_manifest(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    # NOTE: xarray types the first argument as a path
+    request: Any = REQUEST
+    kwargs: dict[str, Any] = {
+        "engine": "ecmwf",
+        "request_client_class": lambda client_kwargs: request_client,
+        "open_dataset": open_pickle,
+        "request_chunks": {"day": 1},
+    }
+    expected = xr.open_dataset(
+        request, cache_kwargs={"cache_folder": str(tmp_path)}, **kwargs
+    ).load()
+
+    for path in tmp_path.glob("*.zarr"):
+        shutil.rmtree(path)
+    res = xr.open_dataset(
+        request,
+        cache_kwargs={"cache_folder": str(tmp_path), "cache_only": True},
+        **kwargs,
+    )
+
+    assert res.identical(expected)
+    assert len(request_client.submitted) == 2
+    assert len(list(tmp_path.glob("*.manifest"))) == 1
+    assert list(tmp_path.glob("*.zarr")) == []
+
+    # the manifest depends on the options of the client and of cfgrib
+    open_kwargs_list: list[dict[str, Any]] = [
+        {"client_kwargs": {"url": "https://example.com"}},
+        {"open_dataset_kwargs": {"backend_kwargs": {"time_dims": ["valid_time"]}}},
+    ]
+    for open_kwargs in open_kwargs_list:
+        xr.open_dataset(
+            request,
+            cache_kwargs={"cache_folder": str(tmp_path)},
+            **kwargs | open_kwargs,
+        )
+
+    assert len(list(tmp_path.glob("*.manifest"))) == 3
+
+
+def test_open_dataset_manifest_failed_variable(tmp_path: Any) -> None:
+    class FlakyRequestClient(DummyRequestClient):
+        fail = True
+
+        def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+            if self.fail and request["variable"] == ["total_precipitation"]:
+                raise RuntimeError("transient error")
+            return super().submit_and_wait_on_result(request)
+
+    request_client = FlakyRequestClient()
+    request: Any = REQUEST | {"variable": ["2m_temperature", "total_precipitation"]}
+    kwargs: dict[str, Any] = {
+        "engine": "ecmwf",
+        "request_client_class": lambda client_kwargs: request_client,
+        "open_dataset": open_pickle,
+        "request_chunks": {"day": 1},
+        "cache_kwargs": {"cache_folder": str(tmp_path)},
+    }
+
+    xr.open_dataset(request, **kwargs)
+
+    assert list(tmp_path.glob("*.manifest")) == []
+
+    request_client.fail = False
+    xr.open_dataset(request, **kwargs)
+
+    [path] = tmp_path.glob("*.manifest")
+    assert {"0", "1"} <= set(os.listdir(path))
+
+
+def test_dataset_cacher_retrieve_values(tmp_path: Any) -> None:
+    opened = []
+
+    def open_dataset(path: str) -> xr.Dataset:
+        opened.append(path)
+        return open_pickle(path)
+
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        DummyRequestClient(),
+        open_dataset,
+        cache_folder=str(tmp_path),
+        memory_cache_size=1024,
+    )
+    expected_path = str(tmp_path / "expected")
+    expected = open_dataset(DummyRequestClient().download(REQUEST, expected_path))
+    opened.clear()
+
+    for key in [slice(0, 2), 3, slice(None)]:
+        res = dataset_cacher.retrieve_values(
+            REQUEST, "t2m", lambda ds: ds.t2m, {"time": key}
+        )
+        np.testing.assert_array_equal(res, expected.t2m.isel(time=key).values)
+
+    assert len(opened) == 1
+    assert dataset_cacher.array_cache.misses == 1
+    assert dataset_cacher.array_cache.hits == 2
+
+
+def test_array_cache() -> None:
+    array_cache = engine_ecmwf.ArrayCache(max_bytes=40)
+    variable = xr.Variable("x", np.arange(2, dtype="int64"))
+
+    array_cache.put("a", variable)
+    array_cache.put("b", variable)
+    assert array_cache.get("a") is variable
+    array_cache.put("c", variable)
+
+    assert list(array_cache.variables) == ["a", "c"]
+    assert array_cache.nbytes == 32
+    assert array_cache.get("b") is None
+
+    array_cache.put("d", xr.Variable("x", np.arange(6, dtype="int64")))
+    assert list(array_cache.variables) == ["a", "c"]
+
+    assert pickle.loads(pickle.dumps(array_cache)).variables == {}
+
+
+def test_dataset_pool() -> None:
+    opened = []
+
+    def open_dataset(path: str) -> xr.Dataset:
+        opened.append(path)
+        return xr.Dataset()
+
+    dataset_pool = engine_ecmwf.DatasetPool(max_size=2)
+
+    with dataset_pool.open("a", open_dataset) as ds:
+        with dataset_pool.open("a", open_dataset) as ds1:
+            assert ds1 is ds
+        with dataset_pool.open("b", open_dataset):
+            with dataset_pool.open("c", open_dataset):
+                assert list(dataset_pool.datasets) == ["a", "b", "c"]
+            # "a" and "b" are in use so "c" is closed
+            assert list(dataset_pool.datasets) == ["a", "b"]
+    with dataset_pool.open("c", open_dataset):
+        pass
+
+    assert list(dataset_pool.datasets) == ["b", "c"]
+    assert opened == ["a", "b", "c", "c"]
+
+
+def test_dataset_cacher_retrieve_concurrent(tmp_path: Any) -> None:
+    class BarrierRequestClient(DummyRequestClient):
+        barrier = threading.Barrier(2, timeout=10)
+
+        def download(self, result: Any, target: str | None = None) -> str:
+            # both downloads must be running at the same time to pass the barrier
+            if result["day"] != ["01", "02"]:
+                self.barrier.wait()
+            return super().download(result, target)
+
+    request_client = BarrierRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client,
+        open_pickle,
+        cache_folder=str(tmp_path),
+        serve_from_supersets=False,
+    )
+
+    def retrieve(request: dict[str, Any]) -> None:
+        with dataset_cacher.retrieve(request):
+            pass
+
+    requests = [REQUEST] * 4 + [REQUEST | {"day": ["01"]}, REQUEST | {"day": ["02"]}]
+    with concurrent.futures.ThreadPoolExecutor(len(requests)) as executor:
+        list(executor.map(retrieve, requests))
+
+    assert len(request_client.submitted) == 3
+
+
+def test_file_lease(tmp_path: Any) -> None:
+    path = str(tmp_path / "file.lock")
+    holders = []
+
+    def hold(index: int) -> None:
+        with engine_ecmwf.FileLease(path, poll_interval=0.01):
+            holders.append(index)
+            time.sleep(0.05)
+            holders.append(index)
+
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        list(executor.map(hold, range(3)))
+
+    assert [holders[i] == holders[i + 1] for i in range(0, 6, 2)] == [True] * 3
+    assert not os.path.exists(path)
+
+    # a stale lease is broken
+    with open(path, "w"):
+        pass
+    os.utime(path, (time.time() - 10, time.time() - 10))
+    with engine_ecmwf.FileLease(path, timeout=5, poll_interval=0.01):
+        assert os.path.exists(path)
+
+    # a fresh lease taken after the check of the stale one is not broken
+    with open(path, "w") as f:
+        f.write("stale")
+    stat = os.stat(path)
+    os.remove(path)
+    with open(path, "w") as f:
+        f.write("fresh")
+    engine_ecmwf.FileLease(path).break_stale(stat)
+    with open(path) as f:
+        assert f.read() == "fresh"
+    os.remove(path)
+
+    # a broken lease taken by another is not removed on release
+    lease = engine_ecmwf.FileLease(path)
+    lease.acquire()
+    os.remove(path)
+    with open(path, "w") as f:
+        f.write("other")
+    lease.release()
+    with open(path) as f:
+        assert f.read() == "other"
+    assert os.listdir(tmp_path) == ["file.lock"]
+
+
+def test_dataset_cacher_retrieve_multiprocessing(tmp_path: Any) -> None:
+    class LoggingRequestClient(DummyRequestClient):
+        def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+            with open(tmp_path / "submitted.log", "a") as f:
+                f.write(f"{os.getpid()}\n")
+            time.sleep(0.1)
+            return request
+
+    def retrieve() -> None:
+        dataset_cacher = engine_ecmwf.DatasetCacher(
+            LoggingRequestClient(), open_pickle, cache_folder=str(tmp_path / "cache")
+        )
+        with dataset_cacher.retrieve(REQUEST):
+            pass
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=retrieve) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert len((tmp_path / "submitted.log").read_text().splitlines()) == 1
+
+
+def test_dataset_cacher_evict_cache(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client,
+        open_pickle,
+        cache_folder=str(tmp_path),
+        max_cache_files=2,
+        min_cache_age=0,
+    )
+    requests = [REQUEST | {"day": [day]} for day in ["01", "02", "01", "03"]]
+    paths = [dataset_cacher.cache_path(request) for request in requests]
+
+    for request in requests:
+        with dataset_cacher.retrieve(request):
+            pass
+        time.sleep(0.01)
+
+    assert sorted(str(path) for path in tmp_path.iterdir()) == sorted(
+        [paths[0], paths[0] + ".json", paths[3], paths[3] + ".json"]
+    )
+
+    # the cfgrib index files count in the size and are removed with their file
+    with open(paths[3] + ".5b7b6.idx", "wb") as f:
+        f.write(b"0" * 1000)
+    entries, idx_paths, locked = dataset_cacher.list_cache_entries()
+    sizes = {path: size for _, size, path in entries}
+    assert sizes[paths[3]] == os.path.getsize(paths[3]) + 1000
+    assert idx_paths == {paths[3]: [paths[3] + ".5b7b6.idx"]}
+
+    dataset_cacher.max_cache_files = 0
+    dataset_cacher.max_cache_size = 1
+    dataset_cacher.evict_cache()
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_dataset_cacher_retrieve_from_superset(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path)
+    )
+    with dataset_cacher.retrieve(REQUEST) as ds:
+        expected = ds.load()
+
+    subsets: list[tuple[dict[str, Any], Any]] = [
+        ({"day": "02"}, slice(2, 4)),
+        ({"day": ["2"], "time": ["1200"]}, 3),
+        ({"time": ["12:00"]}, [1, 3]),
+    ]
+    for subset, key in subsets:
+        with dataset_cacher.retrieve(REQUEST | subset) as ds:
+            assert ds.identical(expected.isel(time=key))
+
+    assert len(request_client.submitted) == 1
+    assert list(tmp_path.glob("*.grib")) == [
+        tmp_path / os.path.basename(dataset_cacher.cache_path(REQUEST))
+    ]
+
+    # not covered by the cached request
+    for request in [REQUEST | {"day": ["02", "03"]}, REQUEST | {"variable": ["tp"]}]:
+        with dataset_cacher.retrieve(request):
+            pass
+
+    assert len(request_client.submitted) == 3
+
+
+def test_dataset_cacher_retrieve_split(tmp_path: Any) -> None:
+    class LimitedRequestClient(DummyRequestClient):
+        def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            if len(request["day"]) * len(request["time"]) > 2:
+                raise client_common.RequestTooLargeError("request too large")
+            return request
+
+    request_client = LimitedRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path)
+    )
+    request = REQUEST | {"day": ["01", "02", "03"]}
+    expected = open_pickle(DummyRequestClient().download(request, str(tmp_path / "x")))
+
+    with dataset_cacher.retrieve(request) as ds:
+        assert ds.identical(expected)
+
+    # split in ["01"] and ["02", "03"] and then ["02"] and ["03"]
+    submitted_days = sorted(r["day"] for r in request_client.submitted)
+    assert submitted_days == [["01"], ["01", "02", "03"], ["02"], ["02", "03"], ["03"]]
+
+    with dataset_cacher.retrieve(request) as ds:
+        assert ds.identical(expected)
+
+    assert len(request_client.submitted) == 5
+
+    with pytest.raises(client_common.RequestTooLargeError):
+        with dataset_cacher.retrieve(
+            request | {"day": ["04"], "time": ["00", "06", "12"]}
+        ):
+            pass
+
+
+def test_dataset_cacher_retrieve_split_levels(tmp_path: Any) -> None:
+    class LevelsRequestClient(DummyRequestClient):
+        def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            if len(request["pressure_level"]) > 1:
+                raise client_common.RequestTooLargeError("request too large")
+            return request
+
+        def download(self, result: Any, target: str | None = None) -> str:
+            assert target is not None
+            # NOTE: like cfgrib the levels are in descending order
+            levels = sorted(map(int, result["pressure_level"]), reverse=True)
+            ds = xr.Dataset(
+                {"t": (("isobaricInhPa",), np.array(levels, dtype="float32"))},
+                coords={"isobaricInhPa": levels},
+            )
+            with open(target, "wb") as f:
+                pickle.dump(ds, f)
+            return target
+
+    request_client = LevelsRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path)
+    )
+    request = REQUEST | {"pressure_level": ["500", "850", "1000"]}
+
+    with dataset_cacher.retrieve(request) as ds:
+        assert ds.isobaricInhPa.values.tolist() == [1000, 850, 500]
+        assert ds.t.values.tolist() == [1000, 850, 500]
+
+
+@pytest.mark.parametrize("max_coalesced_requests, expected_submitted", [(8, 1), (3, 2)])
+def test_dataset_cacher_retrieve_values_coalesce(
+    tmp_path: Any, max_coalesced_requests: int, expected_submitted: int
+) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client,
+        open_pickle,
+        cache_folder=str(tmp_path),
+        coalesce_window=0.2,
+        max_coalesced_requests=max_coalesced_requests,
+    )
+    requests = [REQUEST | {"day": day} for day in ["01", "02", "03", "04"]]
+
+    def retrieve_values(request: dict[str, Any]) -> Any:
+        return dataset_cacher.retrieve_values(request, "t2m", lambda ds: ds.t2m, {})
+
+    with concurrent.futures.ThreadPoolExecutor(len(requests)) as executor:
+        res = list(executor.map(retrieve_values, requests))
+
+    assert len(request_client.submitted) == expected_submitted
+    days = ["01", "02", "03", "04"][:max_coalesced_requests]
+    assert days in [request["day"] for request in request_client.submitted]
+    for request, values in zip(requests, res):
+        path = DummyRequestClient().download(request, str(tmp_path / "expected"))
+        np.testing.assert_array_equal(values, open_pickle(path).t2m.values)
+
+    # a request served from a coalesced file is not coalesced again
+    def wait(*args: Any) -> None:
+        raise AssertionError("coalesced again")
+
+    dataset_cacher.request_coalescer.wait = wait  # type: ignore
+    retrieve_values(requests[0])
+
+    assert len(request_client.submitted) == expected_submitted
+
+
+@pytest.mark.parametrize("limit", [16, 4])
+def test_job_scheduler(tmp_path: Any, monkeypatch: Any, limit: int) -> None:
+    limits = {"limit": limit, "max_limit": limit}
+    service_limits = {"submit": limits, "download": limits}
+    monkeypatch.setitem(
+        client_common.SERVICE_LIMITS, "AsyncRequestClient", service_limits
+    )
+    monkeypatch.setattr(client_common, "SERVICE_LIMITERS", {})
+
+    class AsyncRequestClient(DummyRequestClient):
+        lock = threading.Lock()
+        in_flight = 0
+        max_in_flight = 0
+        # NOTE: no job completes before `limit` jobs are in flight
+        all_in_flight = threading.Event()
+
+        def submit(self, request: dict[str, Any]) -> Any:
+            with self.lock:
+                self.submitted.append(request)
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                if self.in_flight == limit:
+                    self.all_in_flight.set()
+            return {"request": request, "polls": 2}
+
+        def poll(self, job: dict[str, Any]) -> Any:
+            # NOTE: a blocking poll would starve the executor running the submits
+            if not self.all_in_flight.is_set():
+                return None
+            job["polls"] -= 1
+            if job["polls"] > 0:
+                return None
+            with self.lock:
+                self.in_flight -= 1
+            return job["request"]
+
+    request_client = AsyncRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path), poll_interval=0.01
+    )
+    requests = [REQUEST | {"day": f"{day:02d}"} for day in range(1, 17)]
+
+    dataset_cacher.prefetch(requests)
+    for request in requests:
+        with dataset_cacher.retrieve(request) as ds:
+            path = DummyRequestClient().download(request, str(tmp_path / "expected"))
+            assert ds.identical(open_pickle(path))
+
+    assert len(request_client.submitted) == len(requests)
+    assert request_client.max_in_flight == limit
+
+    dataset_cacher.prefetch(requests)
+    assert len(request_client.submitted) == len(requests)
+
+
+def test_job_scheduler_ready_on_submit(tmp_path: Any) -> None:
+    class ReadyRequestClient(DummyRequestClient):
+        def submit(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            return request
+
+        def poll(self, job: dict[str, Any]) -> Any:
+            return job
+
+    request_client = ReadyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path), poll_interval=60
+    )
+
+    start = time.perf_counter()
+    with dataset_cacher.retrieve(REQUEST):
+        pass
+
+    assert request_client.submitted == [REQUEST]
+    assert time.perf_counter() - start < 30
+
+
+def test_job_scheduler_throttled(tmp_path: Any, monkeypatch: Any) -> None:
+    monkeypatch.setattr(client_common, "SERVICE_LIMITERS", {})
+
+    class TooManyRequestsError(Exception):
+        response = types.SimpleNamespace(status_code=429)
+
+    class ThrottledRequestClient(DummyRequestClient):
+        def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            if len(self.submitted) <= 2:
+                raise TooManyRequestsError("Too Many Requests")
+            return request
+
+    request_client = ThrottledRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path), poll_interval=0.01
+    )
+
+    with dataset_cacher.retrieve(REQUEST):
+        pass
+
+    assert len(request_client.submitted) == 3
+    # 4 halved twice and increased by 1 / 1
+    limiter = client_common.get_service_limiter(request_client, "submit")
+    assert limiter.limit == 2
+    assert limiter.active == 0
+
+
+def test_job_scheduler_throttled_poll(tmp_path: Any, monkeypatch: Any) -> None:
+    monkeypatch.setattr(client_common, "SERVICE_LIMITERS", {})
+
+    class ThrottledPollRequestClient(DummyRequestClient):
+        polls = 0
+
+        def submit(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            return request
+
+        def poll(self, job: dict[str, Any]) -> Any:
+            self.polls += 1
+            if self.polls <= 3:
+                raise client_common.RequestThrottledError("Too Many Requests")
+            return job
+
+    request_client = ThrottledPollRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client,
+        open_pickle,
+        cache_folder=str(tmp_path),
+        poll_interval=0.01,
+        cache_file=False,
+    )
+
+    with dataset_cacher.retrieve(REQUEST):
+        pass
+
+    assert request_client.submitted == [REQUEST]
+    assert request_client.polls == 4
+
+
+def test_dataset_cacher_prefetch_lease_held(tmp_path: Any) -> None:
+    request_client = DummyRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path)
+    )
+    path = dataset_cacher.cache_path(REQUEST)
+    lease = engine_ecmwf.FileLease(path + ".lock", timeout=60)
+    lease.acquire()
+    try:
+        dataset_cacher.prefetch([REQUEST])
+    finally:
+        lease.release()
+
+    assert request_client.submitted == []
+    assert pickle.loads(pickle.dumps(dataset_cacher.job_scheduler)).futures == {}
+
+
+def test_dataset_cacher_resume_jobs(tmp_path: Any) -> None:
+    class ResumableRequestClient(DummyRequestClient):
+        def __init__(self) -> None:
+            super().__init__()
+            self.attached: list[str] = []
+
+        def submit(self, request: dict[str, Any]) -> Any:
+            self.submitted.append(request)
+            return {"id": f"job-{len(self.submitted)}", "request": request}
+
+        def poll(self, job: dict[str, Any]) -> Any:
+            if job["id"] == "expired":
+                raise RuntimeError("job not found")
+            return job["request"]
+
+        def get_job_id(self, job: dict[str, Any]) -> str:
+            return job["id"]  # type: ignore
+
+        def attach(self, job_id: str) -> Any:
+            self.attached.append(job_id)
+            return {"id": job_id, "request": REQUEST}
+
+    request_client = ResumableRequestClient()
+    dataset_cacher = engine_ecmwf.DatasetCacher(
+        request_client, open_pickle, cache_folder=str(tmp_path), poll_interval=0.01
+    )
+    path = dataset_cacher.cache_path(REQUEST)
+    canonical = client_common.canonical_request(REQUEST)
+
+    # a job submitted by a process that died
+    entry = {"request": canonical, "job_id": "job-0", "state": "submitted"}
+    engine_ecmwf.save_json(entry, path + ".job")
+
+    with dataset_cacher.retrieve(REQUEST):
+        pass
+
+    assert request_client.submitted == []
+    assert request_client.attached == ["job-0"]
+    assert not os.path.exists(path + ".job")
+
+    dataset_cacher.remove_cache_entry(path)
+    entry = {"request": canonical, "job_id": "expired", "state": "submitted"}
+    engine_ecmwf.save_json(entry, path + ".job")
+
+    with dataset_cacher.retrieve(REQUEST):
+        pass
+
+    assert request_client.submitted == [REQUEST]
+    assert request_client.attached == ["job-0", "expired"]
+    assert not os.path.exists(path + ".job")
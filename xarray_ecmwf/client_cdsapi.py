@@ -1,10 +1,15 @@
-import bisect
+import concurrent.futures
+import functools
+import itertools
 import logging
-from typing import Any
+import math
+import os
+from typing import Any, Iterable
 
 import attrs
 import cdsapi
 import numpy as np
+import pandas as pd
 import xarray as xr
 
 from . import client_common
@@ -14,21 +19,87 @@ LOGGER = logging.getLogger(__name__)
 DIMS_ORDER = ("valid_time", "time", "step", "isobaricInhPa", "number", "values")
 
 
+CLIENT_POOL = client_common.ClientPool(cdsapi.Client)
+
+# fragments of the error messages of the CDS when a request exceeds the limits
+TOO_LARGE_MESSAGES = ("too large", "cost limits exceeded", "limit is")
+
+
 @attrs.define
 class CdsapiRequestClient:
     client_kwargs: dict[str, Any] = {"quiet": True, "retry_max": 1}
 
-    def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+    def retrieve(self, request: dict[str, Any], wait_until_complete: bool) -> Any:
         request = request.copy()
         dataset = request.pop("dataset")
-        client = cdsapi.Client(**self.client_kwargs)
-        return client.retrieve(dataset, request | {"format": "grib"})
+        client_kwargs = self.client_kwargs | {
+            "wait_until_complete": wait_until_complete
+        }
+        try:
+            with CLIENT_POOL.client(**client_kwargs) as client:
+                return client.retrieve(dataset, request | {"format": "grib"})
+        except Exception as ex:
+            message = str(ex).lower()
+            if any(fragment in message for fragment in TOO_LARGE_MESSAGES):
+                raise client_common.RequestTooLargeError(str(ex)) from ex
+            raise
+
+    def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
+        return self.retrieve(request, wait_until_complete=True)
+
+    def get_endpoint(self) -> str:
+        return self.client_kwargs.get("url") or os.environ.get("CDSAPI_URL", "")
+
+    def submit(self, request: dict[str, Any]) -> Any:
+        return self.retrieve(request, wait_until_complete=False)
+
+    def poll(self, job: Any) -> Any:
+        if hasattr(job, "results_ready"):
+            # ecmwf-datastores remote, raises if the job failed
+            return job if job.results_ready else None
+        job.update()
+        state = job.reply["state"]
+        if state == "completed":
+            return job
+        elif state in ("queued", "running"):
+            return None
+        error = job.reply.get("error", {})
+        message = f"{error.get('message')}. {error.get('reason')}."
+        if any(fragment in message.lower() for fragment in TOO_LARGE_MESSAGES):
+            raise client_common.RequestTooLargeError(message)
+        raise RuntimeError(f"request failed with state {state}: {message}")
+
+    def get_job_id(self, job: Any) -> str:
+        if isinstance(job, cdsapi.api.Result):
+            return job.reply["request_id"]  # type: ignore
+        return job.request_id  # type: ignore
+
+    def attach(self, job_id: str) -> Any:
+        with CLIENT_POOL.client(**self.client_kwargs) as client:
+            if not hasattr(client, "client"):
+                reply = {"request_id": job_id, "state": "queued"}
+                return cdsapi.api.Result(client, reply)
+            # ecmwf-datastores legacy client
+            return client.client.get_remote(job_id)
 
     def get_filename(self, result: Any) -> str:
         return result.location.split("/")[-1]  # type: ignore
 
     def download(self, result: Any, target: str | None = None) -> str:
-        return result.download(target)  # type: ignore
+        if hasattr(result, "get_results"):
+            # ecmwf-datastores remote
+            result = result.get_results()
+        if target is None:
+            return result.download(target)  # type: ignore
+        asset = getattr(result, "asset", {})
+        checksum = client_common.parse_multihash(asset.get("file:checksum"))
+        return client_common.download_with_resume(
+            result.location,
+            target,
+            size=result.content_length,
+            checksum=checksum,
+            session=getattr(result, "session", None),
+        )
 
 
 SUPPORTED_REQUEST_DIMENSIONS = [
@@ -43,15 +114,36 @@ SUPPORTED_REQUEST_DIMENSIONS = [
     "pressure_level",
     "levelist",
 ]
+TIME_REQUEST_KEYS = {"date", "year", "month", "day", "time"}
+
+# maximum number of fields in a request by dataset, used by `request_chunks="auto"`
+FIELD_LIMITS = {
+    "reanalysis-era5-single-levels": 120_000,
+    "reanalysis-era5-pressure-levels": 120_000,
+}
+DEFAULT_FIELD_LIMIT = 10_000
 
 
 @attrs.define(slots=False)
 class CdsapiRequestChunker:
     request: dict[str, Any]
-    request_chunks: dict[str, Any]
+    # "auto" picks the chunks with the fewest requests within `max_fields` and
+    # `target_chunk_bytes`, see `resolve_request_chunks`
+    request_chunks: dict[str, Any] | str
     merge_date_time: bool = True
     time_dim: str = "time"
     time_sep: str = "/"
+    max_workers: int = 8
+    # submit one request with all the variables per chunk and select the variable
+    # from the resulting GRIB file
+    merge_variables: bool = False
+    # discover the variables with the smallest sample request and build all the
+    # request dimensions coordinates from the request
+    probe_sample: bool = False
+    # maximum number of fields per request, by default from FIELD_LIMITS
+    max_fields: int | None = None
+    target_chunk_bytes: int = 128 * 2**20
+    failed_variables: list[str] = attrs.field(factory=list, init=False)
 
     def get_request_dimensions(self) -> dict[str, list[Any]]:
         request_dimensions: dict[str, list[Any]] = {}
@@ -66,138 +158,397 @@ class CdsapiRequestChunker:
     def get_chunks(self) -> dict[str, int | tuple[int, ...]]:
         return self.chunks
 
+    def get_request_chunks(self) -> dict[str, Any]:
+        if isinstance(self.request_chunks, str):
+            raise ValueError(f"request_chunks={self.request_chunks!r} not resolved")
+        return self.request_chunks
+
+    def has_time_request(self) -> bool:
+        return "time" in self.request and any(
+            isinstance(self.request.get(key), list)
+            for key in ["date", "year", "month", "day"]
+        )
+
+    def get_time_request(self) -> dict[str, Any]:
+        override_time = {}
+        if self.merge_date_time is False:
+            override_time["time"] = ["00:00"]
+        return self.request | override_time
+
+    def evaluate_time_chunks(self, time_chunks: dict[str, int]) -> tuple[int, int]:
+        # number of requests and time steps of the largest request
+        time, time_chunk, time_chunk_requests = client_common.build_time_chunk_requests(
+            self.get_time_request(), time_chunks, self.time_sep
+        )
+        if not time_chunks:
+            return 1, time.size
+        if isinstance(time_chunk, tuple):
+            return len(time_chunk_requests), max(time_chunk, default=0)
+        return len(time_chunk_requests), min(time_chunk, time.size)
+
+    def get_time_chunks_bounds(self) -> dict[str, int]:
+        if "date" in self.request:
+            start, stop = map(
+                pd.Timestamp, self.request["date"][0].split(self.time_sep)
+            )
+            return {
+                "year": stop.year - start.year + 1,
+                "month": (stop.year - start.year) * 12 + stop.month - start.month + 1,
+                "day": (stop - start).days + 1,
+            }
+        return {unit: len(self.request[unit]) for unit in ["year", "month", "day"]}
+
+    def choose_time_chunks(self, max_steps: int) -> tuple[dict[str, int], int, int]:
+        # the time chunks with the fewest requests of at most `max_steps` time steps
+        jobs, steps = self.evaluate_time_chunks({})
+        if steps <= max_steps:
+            return {}, jobs, steps
+        best = ({"day": 1}, *self.evaluate_time_chunks({"day": 1}))
+        for unit, size in self.get_time_chunks_bounds().items():
+            # NOTE: the largest request grows with the chunk, so bisect on it
+            lo, hi = 0, size
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.evaluate_time_chunks({unit: mid})[1] <= max_steps:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo == 0:
+                continue
+            jobs, steps = self.evaluate_time_chunks({unit: lo})
+            if jobs < best[1]:
+                best = ({unit: lo}, jobs, steps)
+        return best
+
+    def choose_request_chunks(
+        self, field_bytes: int, nfields: int
+    ) -> tuple[dict[str, int], dict[str, Any]]:
+        # `field_bytes` and `nfields` are the size of a request with one value for
+        # each request dimension
+        max_fields = self.max_fields or FIELD_LIMITS.get(
+            self.request.get("dataset", ""), DEFAULT_FIELD_LIMIT
+        )
+        dims_sizes = {
+            dim: len(values)
+            for dim, values in self.get_request_dimensions().items()
+            if dim not in TIME_REQUEST_KEYS
+        }
+        step_size = math.prod(dims_sizes.values())
+        if self.merge_date_time is False and isinstance(self.request["time"], list):
+            step_size *= len(self.request["time"])
+        step_fields = nfields * step_size
+        step_bytes = max(field_bytes, 1) * step_size
+        max_steps = min(
+            max_fields // step_fields, self.target_chunk_bytes // step_bytes
+        )
+
+        request_chunks: dict[str, int] = {}
+        jobs, steps = 1, 1
+        if self.has_time_request():
+            request_chunks, jobs, steps = self.choose_time_chunks(max(max_steps, 1))
+
+        # split the largest of the other dimensions too if the smallest time chunk
+        # is too large
+        dim_size = 1
+        if steps > max_steps and dims_sizes:
+            dim, dim_size = max(dims_sizes.items(), key=lambda item: item[1])
+            value_fields = steps * step_fields // dim_size
+            value_bytes = steps * step_bytes // dim_size
+            dim_chunk = min(
+                max_fields // value_fields, self.target_chunk_bytes // value_bytes
+            )
+            dim_chunk = max(dim_chunk, 1)
+            request_chunks[dim] = dim_chunk
+            jobs *= -(-dim_size // dim_chunk)
+            step_fields = step_fields // dim_size * dim_chunk
+            step_bytes = step_bytes // dim_size * dim_chunk
+
+        if steps * step_fields > max_fields:
+            # NOTE: the time steps of a day are never split
+            LOGGER.warning(
+                f"{steps * step_fields} fields per request exceed max_fields={max_fields}"
+            )
+
+        chunk_cost = {
+            "request_chunks": request_chunks,
+            "jobs": jobs,
+            "fields": steps * step_fields,
+            "bytes": steps * step_bytes,
+            "max_fields": max_fields,
+            "target_chunk_bytes": self.target_chunk_bytes,
+        }
+        return request_chunks, chunk_cost
+
+    def resolve_request_chunks(
+        self, dataset_cacher: client_common.DatasetCacherProtocol
+    ) -> None:
+        if self.request_chunks != "auto":
+            return
+        probe_request = self.get_probe_request()
+        with dataset_cacher.cached_empty_dataset(probe_request) as probe_ds:
+            field_bytes = sum(da.nbytes for da in probe_ds.data_vars.values())
+            nfields = len(probe_ds.data_vars)
+        self.request_chunks, self.chunk_cost = self.choose_request_chunks(
+            field_bytes, nfields
+        )
+        LOGGER.info(f"chosen request chunks {self.chunk_cost}")
+
     def maybe_update_coords_and_chunk_info(
         self,
         request_coord_name: str,
         coord_name: str,
+        chunks: dict[str, Any],
+        chunk_plans: dict[str, client_common.ChunkPlan],
+        chunked_coords: dict[str, Any],
         indexer_kwargs: dict["str", Any] = {},
         dtype: str = "int32",
     ) -> None:
-        if request_coord_name in self.request_chunks:
+        request_chunks = self.get_request_chunks()
+        if request_coord_name in request_chunks or self.probe_sample:
             if isinstance(self.request.get(request_coord_name), list):
                 (
                     coord,
                     coord_chunk,
                     coord_chunk_request,
                 ) = client_common.build_chunks_header_requests(
-                    request_coord_name, self.request, self.request_chunks, dtype=dtype
+                    request_coord_name, self.request, request_chunks, dtype=dtype
                 )
-                self.chunks[coord_name] = coord_chunk
-                self.chunk_requests[coord_name] = coord_chunk_request
+                if request_coord_name in request_chunks:
+                    chunk_plan = client_common.ChunkPlan.from_chunk_requests(
+                        coord_chunk_request, coord.size
+                    )
+                    chunks[coord_name] = coord_chunk
+                    chunk_plans[coord_name] = chunk_plan
                 if coord_name == "step":
-                    self.chunked_coords[coord_name] = xr.IndexVariable(  # type: ignore
+                    chunked_coords[coord_name] = xr.IndexVariable(  # type: ignore
                         "step",
                         coord * np.timedelta64(3600000000000, "ns"),
                         **indexer_kwargs,
                     )
                 else:
-                    self.chunked_coords[coord_name] = xr.IndexVariable(  # type: ignore
+                    chunked_coords[coord_name] = xr.IndexVariable(  # type: ignore
                         coord_name, coord, {}
                     )
         return
 
     def compute_chunked_request_coords(self) -> dict[str, Any]:
-        self.chunks = {}
-        self.chunk_requests = {}
-        self.chunked_coords = {}
-
-        if "time" in self.request:
-            if (
-                isinstance(self.request.get("date"), list)
-                or isinstance(self.request.get("year"), list)
-                or isinstance(self.request.get("month"), list)
-                or isinstance(self.request.get("day"), list)
-            ):
-                override_time = {}
-                if self.merge_date_time is False:
-                    override_time["time"] = ["00:00"]
-                (
-                    time,
-                    time_chunk,
-                    time_chunk_requests,
-                ) = client_common.build_time_chunk_requests(
-                    self.request | override_time, self.request_chunks, self.time_sep
+        chunks: dict[str, Any] = {}
+        chunk_plans: dict[str, client_common.ChunkPlan] = {}
+        chunked_coords: dict[str, Any] = {}
+
+        if self.has_time_request():
+            (
+                time,
+                time_chunk,
+                time_chunk_requests,
+            ) = client_common.build_time_chunk_requests(
+                self.get_time_request(), self.get_request_chunks(), self.time_sep
+            )
+            if len(time_chunk_requests) > 1:
+                chunk_plan = client_common.ChunkPlan.from_chunk_requests(
+                    time_chunk_requests, time.size
                 )
-                if len(time_chunk_requests) > 1:
-                    self.chunks[self.time_dim] = time_chunk
-                    self.chunk_requests[self.time_dim] = time_chunk_requests
-                    self.chunked_coords[self.time_dim] = xr.IndexVariable(  # type: ignore
-                        self.time_dim, time, {}
-                    )
-        self.maybe_update_coords_and_chunk_info("leadtime_hour", "step")
-        self.maybe_update_coords_and_chunk_info("step", "step")
+                chunks[self.time_dim] = time_chunk
+                chunk_plans[self.time_dim] = chunk_plan
+            if len(time_chunk_requests) > 1 or self.probe_sample:
+                chunked_coords[self.time_dim] = xr.IndexVariable(  # type: ignore
+                    self.time_dim, time, {}
+                )
+        out = (chunks, chunk_plans, chunked_coords)
+        self.maybe_update_coords_and_chunk_info("leadtime_hour", "step", *out)
+        self.maybe_update_coords_and_chunk_info("step", "step", *out)
         self.maybe_update_coords_and_chunk_info(
-            "pressure_level", "isobaricInhPa", indexer_kwargs={"units": "hPa"}
+            "pressure_level", "isobaricInhPa", *out, indexer_kwargs={"units": "hPa"}
         )
         self.maybe_update_coords_and_chunk_info(
-            "levelist", "isobaricInhPa", indexer_kwargs={"units": "hPa"}
+            "levelist", "isobaricInhPa", *out, indexer_kwargs={"units": "hPa"}
         )
         # `number` is last because some CDS datasets do not allow to select
         # ensemble members in the request and always return all of them.
         # In this case we set the dimension in `get_coords_attrs_and_dtype`
-        self.maybe_update_coords_and_chunk_info(
-            "number",
-            "number",
-            dtype="int64",
-        )
-        return self.chunked_coords.copy()
+        self.maybe_update_coords_and_chunk_info("number", "number", *out, dtype="int64")
+        # NOTE: the attributes are replaced and never mutated so the threads reading
+        #   the chunks never see a partial plan
+        self.chunks = chunks
+        self.chunk_plans = chunk_plans
+        self.chunked_coords = chunked_coords
+        return chunked_coords.copy()
 
     def get_coords_attrs_and_dtype(
         self, dataset_cacher: client_common.DatasetCacherProtocol
     ) -> tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any]:
-        chunked_request_coords = self.compute_chunked_request_coords()
-        self.request_chunked_dims = list(self.chunked_coords)
-        sample_request = self.first_chunk_request()
+        self.resolve_request_chunks(dataset_cacher)
+        self.compute_chunked_request_coords()
+        self.request_chunked_dims = list(self.chunk_plans)
+        sample_request = self.get_sample_request()
         with dataset_cacher.cached_empty_dataset(sample_request) as sample_ds:
             da = list(sample_ds.data_vars.values())[0]
-            coords: dict[str, Any] = {}
-            # ensure order
-            for name in DIMS_ORDER:
-                if name in chunked_request_coords:
-                    coords[name] = chunked_request_coords[name]
-                elif name in da.dims:
-                    assert isinstance(name, str)
-                    coords[name] = da.coords[name]
-            for name in da.coords:  # type: ignore
-                if name not in coords and name in da.dims:
-                    assert isinstance(name, str)
-                    coords[name] = da.coords[name]
-            self.dims = list(coords)
-            return str(da.name), coords, sample_ds.attrs, da.attrs, da.dtype
+            return self.get_coords_attrs_and_dtype_from_sample(sample_ds, da)
 
-    def get_variables(self) -> dict[str, "CdsapiRequestChunker"]:
+    def get_coords_attrs_and_dtype_from_sample(
+        self, sample_ds: xr.Dataset, da: xr.DataArray
+    ) -> tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any]:
+        chunked_request_coords = self.chunked_coords
+        coords: dict[str, Any] = {}
+        # ensure order
+        for name in DIMS_ORDER:
+            if name in chunked_request_coords:
+                coords[name] = chunked_request_coords[name]
+            elif name in da.dims:
+                assert isinstance(name, str)
+                coords[name] = da.coords[name]
+        for name in da.coords:  # type: ignore
+            if name not in coords and name in da.dims:
+                assert isinstance(name, str)
+                coords[name] = da.coords[name]
+        var_def = (str(da.name), coords, sample_ds.attrs, da.attrs, da.dtype)
+        self.restore_var_def(var_def)
+        return var_def
+
+    def get_manifest(self) -> dict[str, Any]:
+        # NOTE: `request_chunks` is resolved by `get_coords_attrs_and_dtype`
+        return attrs.asdict(self, recurse=False, filter=lambda a, _: a.init)
+
+    def restore_var_def(
+        self, var_def: tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any]
+    ) -> None:
+        name, coords, _, var_attrs, dtype = var_def
+        if not hasattr(self, "chunk_plans"):
+            self.compute_chunked_request_coords()
+            self.request_chunked_dims = list(self.chunk_plans)
+        self.dims = list(coords)
+        self.shape = tuple(c.size for c in coords.values())
+        self.dtype = dtype
+        self.var_name = name
+        self.var_param_id = var_attrs.get("GRIB_paramId")
+
+    def get_merged_variables_coords_attrs_and_dtype(
+        self, dataset_cacher: client_common.DatasetCacherProtocol
+    ) -> list[
+        tuple[
+            "CdsapiRequestChunker",
+            tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any],
+        ]
+    ]:
+        self.resolve_request_chunks(dataset_cacher)
+        self.compute_chunked_request_coords()
+        sample_request = self.get_sample_request()
+        retval = []
+        with dataset_cacher.cached_empty_dataset(sample_request) as sample_ds:
+            for da in sample_ds.data_vars.values():
+                var_request_chunker = attrs.evolve(self)
+                var_request_chunker.compute_chunked_request_coords()
+                var_request_chunker.request_chunked_dims = list(self.chunk_plans)
+                var_def = var_request_chunker.get_coords_attrs_and_dtype_from_sample(
+                    sample_ds, da
+                )
+                retval.append((var_request_chunker, var_def))
+        return retval
+
+    def get_variables_coords_attrs_and_dtype(
+        self,
+        dataset_cacher: client_common.DatasetCacherProtocol,
+        drop_variables: Iterable[str] = (),
+    ) -> list[
+        tuple[
+            "CdsapiRequestChunker",
+            tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any],
+        ]
+    ]:
+        param = self.get_param()
+        # drop_variables: both on the requested variables...
+        names = [name for name in self.request[param] if name not in drop_variables]
+        self.failed_variables = []
+        if self.merge_variables:
+            request_chunker = attrs.evolve(self, request=self.request | {param: names})
+            return request_chunker.get_merged_variables_coords_attrs_and_dtype(
+                dataset_cacher
+            )
+
+        var_request_chunkers = self.get_variables()
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = {
+                name: executor.submit(
+                    var_request_chunkers[name].get_coords_attrs_and_dtype,
+                    dataset_cacher,
+                )
+                for name in names
+            }
+        retval = []
+        failed_variables = []
+        for name, future in futures.items():
+            try:
+                var_def = future.result()
+                LOGGER.info(f"found  variable {name} as {var_def[0]}")
+            except Exception as ex:
+                LOGGER.exception(f"failed to define variable {name}")
+                failed_variables.append(name)
+                latest_ex = ex
+                continue
+            retval.append((var_request_chunkers[name], var_def))
+        self.failed_variables = failed_variables
+        if names and not retval:
+            raise latest_ex
+        return retval
+
+    def get_param(self) -> str:
         if "variable" in self.request:
             param = "variable"
         elif "param" in self.request:
             param = "param"
         else:
             raise ValueError(f"'variable' parameter not found in {list(self.request)}")
+        return param
+
+    def get_variables(self) -> dict[str, "CdsapiRequestChunker"]:
+        param = self.get_param()
         retval = {}
         for name in self.request[param]:
             var_request = self.request | {param: [name]}
-            retval[name] = CdsapiRequestChunker(**vars(self) | {"request": var_request})
+            retval[name] = attrs.evolve(self, request=var_request)
         return retval
 
+    def select_data_array(self, ds: xr.Dataset) -> xr.DataArray:
+        data_vars = list(ds.data_vars.values())
+        if len(data_vars) == 1:
+            return data_vars[0]
+        for da in data_vars:
+            if self.var_param_id is not None:
+                if da.attrs.get("GRIB_paramId") == self.var_param_id:
+                    return da
+            elif da.name == self.var_name:
+                return da
+        raise ValueError(f"variable {self.var_name} not found in {list(ds.data_vars)}")
+
     def build_requests(self, chunk_requests: dict[str, Any]) -> dict[str, Any]:
         request = self.request.copy()
         request.update(**chunk_requests)
         return request
 
     def find_chunk_index(self, dim: str, key: int) -> int:
-        if key is not None:
-            start_chunks = [chunk[0] for chunk in self.chunk_requests[dim]]
-            # to check
-            index = bisect.bisect(start_chunks, key) - 1
-        else:
-            index = 0
-        return index
+        return int(self.chunk_plans[dim].find_chunks(key))
 
     def first_chunk_request(self) -> dict[str, Any]:
         request = self.request.copy()
-        for chunks in self.chunk_requests.values():
-            request.update(**chunks[0][1])
+        for chunk_plan in self.chunk_plans.values():
+            request.update(**chunk_plan.fragments[0])
+        return request
+
+    def get_probe_request(self) -> dict[str, Any]:
+        request = self.request.copy()
+        for dim, values in self.get_request_dimensions().items():
+            if dim == "date":
+                start = str(values[0]).split(self.time_sep)[0]
+                request[dim] = [f"{start}{self.time_sep}{start}"]
+            else:
+                request[dim] = values[:1]
         return request
 
+    def get_sample_request(self) -> dict[str, Any]:
+        if self.probe_sample:
+            return self.get_probe_request()
+        return self.first_chunk_request()
+
     def ensure_dims_order(self, da: xr.DataArray) -> xr.DataArray:
         dims = []
         for dim in self.dims:
@@ -205,83 +556,151 @@ class CdsapiRequestChunker:
                 dims.append(dim)
         return da.transpose(*dims)
 
+    def get_chunk_size(self, dim: str, chunk_index: int) -> int:
+        return int(self.chunk_plans[dim].sizes[chunk_index])
+
+    def get_dim_chunk_selections(
+        self, dim: str, key: client_common.KeyType
+    ) -> list[tuple[int, client_common.KeyType, slice | None]]:
+        # returns `(chunk_index, chunk_key, out_key)` for every chunk accessed by `key`
+        # where `out_key` is None when the dimension is dropped by an integer key
+        chunk_plan = self.chunk_plans[dim]
+        if isinstance(key, (int, np.integer)):
+            chunk_index = self.find_chunk_index(dim, int(key))
+            return [(chunk_index, int(key - chunk_plan.starts[chunk_index]), None)]
+        elif isinstance(key, slice):
+            indices = np.arange(self.shape[self.dims.index(dim)])[key]
+        elif isinstance(key, np.ndarray):
+            # NOTE: xarray sends outer indexers sorted in increasing order
+            indices = key
+        else:
+            raise ValueError(f"key type {type(key)} not supported")
+
+        chunk_indices = chunk_plan.find_chunks(indices)
+        # split the indices in runs falling in the same chunk
+        bounds = (np.flatnonzero(np.diff(chunk_indices)) + 1).tolist()
+        selections: list[tuple[int, client_common.KeyType, slice | None]] = []
+        for start, stop in zip([0] + bounds, bounds + [indices.size]):
+            if start == stop:
+                continue
+            chunk_index = int(chunk_indices[start])
+            chunk_key = as_slice(indices[start:stop] - chunk_plan.starts[chunk_index])
+            selections.append((chunk_index, chunk_key, slice(start, stop)))
+        return selections
+
     def get_chunk_requests(
         self,
-        key: tuple[int | slice, ...],
-    ) -> tuple[dict[str, Any], dict[str, int | slice], dict[str, int]]:
-        # XXX: only support `key` that access exactly one chunk
+        key: tuple[client_common.KeyType, ...],
+    ) -> list[tuple[dict[str, Any], dict[str, Any], tuple[Any, ...], dict[str, int]]]:
         assert len(key) == len(self.dims)
-        chunks_key = {}
-        for name, k in zip(self.dims, key):
-            if name in self.request_chunked_dims:
-                chunks_key[name] = k
-
-        chunks_requests: dict[str, Any] = {}
-        selection = dict(zip(self.dims, key))
-        indices = {}
-        for dim, request_key in chunks_key.items():
-            if isinstance(request_key, slice):
-                chunk_index = self.find_chunk_index(dim, request_key.start)
-                start_chunk = self.chunk_requests[dim][chunk_index][0]
-                chunks_requests.update(**self.chunk_requests[dim][chunk_index][1])
-                # compute relative index
-                if request_key.start is None:
-                    start = None
-                else:
-                    start = request_key.start - start_chunk
-                if request_key.stop is None:
-                    stop = None
-                else:
-                    stop = request_key.stop - start_chunk
-                selection[dim] = slice(start, stop, request_key.step)
-
-            elif isinstance(request_key, int):
-                chunk_index = self.find_chunk_index(dim, request_key)
-                start_chunk = self.chunk_requests[dim][chunk_index][0]
-                chunks_requests.update(**self.chunk_requests[dim][chunk_index][1])
-                selection[dim] = request_key - start_chunk
+        dims_selections = []
+        for dim, k in zip(self.dims, key):
+            if dim in self.request_chunked_dims:
+                dims_selections.append(self.get_dim_chunk_selections(dim, k))
+            elif isinstance(k, (int, np.integer)):
+                dims_selections.append([(0, k, None)])
             else:
-                raise ValueError(f"key type {type(request_key)} not supported")
-            indices[dim] = chunk_index
+                dims_selections.append([(0, k, slice(None))])
+
+        chunks_requests = []
+        for chunks_selection in itertools.product(*dims_selections):
+            chunk_requests: dict[str, Any] = {}
+            selection = {}
+            indices = {}
+            out_key = []
+            for dim, (chunk_index, chunk_key, dim_out_key) in zip(
+                self.dims, chunks_selection
+            ):
+                if dim in self.request_chunked_dims:
+                    chunk_requests.update(
+                        **self.chunk_plans[dim].fragments[chunk_index]
+                    )
+                    indices[dim] = chunk_index
+                selection[dim] = chunk_key
+                if dim_out_key is not None:
+                    out_key.append(dim_out_key)
+            field_request = self.build_requests(chunk_requests)
+            chunks_requests.append((field_request, selection, tuple(out_key), indices))
+        return chunks_requests
+
+    def get_out_shape(self, key: tuple[client_common.KeyType, ...]) -> tuple[int, ...]:
+        shape = []
+        for size, k in zip(self.shape, key):
+            if isinstance(k, slice):
+                shape.append(len(range(*k.indices(size))))
+            elif isinstance(k, np.ndarray):
+                shape.append(k.size)
+        return tuple(shape)
+
+    def select_chunk_data_array(
+        self, ds: xr.Dataset, indices: dict[str, int]
+    ) -> xr.DataArray:
+        da = self.ensure_dims_order(self.select_data_array(ds))
+
+        axis = []
+        dims = []
+        for ax, dim in enumerate(self.dims):
+            if dim not in da.dims:
+                axis.append(ax)
+                dims.append(dim)
+
+        da = da.expand_dims(dims, axis=axis)
+
+        # horrible workaround for the crazy CDS / MARS convention to return
+        # a short request at the start of a dataset (at least on ERA5 and ERA5 Land)
+        if self.time_dim in indices and indices[self.time_dim] == 0:
+            time_chunk = self.get_chunk_size(self.time_dim, 0)
+            if da.sizes[self.time_dim] < time_chunk:
+                offset = time_chunk - da.sizes[self.time_dim]
+                da = da.pad({self.time_dim: (offset, 0)})
+
+        return da
 
-        field_request = self.build_requests(chunks_requests)
-        return field_request, selection, indices
+    def retrieve_chunk_values(
+        self,
+        field_request: dict[str, Any],
+        selection: dict[str, Any],
+        indices: dict[str, int],
+        dataset_cacher: client_common.DatasetCacherProtocol,
+    ) -> np.typing.NDArray[Any]:
+        return dataset_cacher.retrieve_values(
+            field_request,
+            str(self.var_name),
+            functools.partial(self.select_chunk_data_array, indices=indices),
+            selection,
+        )
 
     def get_chunk_values(
         self,
-        key: tuple[int | slice, ...],
+        key: tuple[client_common.KeyType, ...],
         dataset_cacher: client_common.DatasetCacherProtocol,
     ) -> np.typing.ArrayLike:
-        field_request, selection, indices = self.get_chunk_requests(key)
-        with dataset_cacher.retrieve(field_request) as ds:
-            da = list(ds.data_vars.values())[0]
-            da = self.ensure_dims_order(da)
-
-            axis = []
-            dims = []
-            for ax, dim in enumerate(self.dims):
-                if dim not in da.dims:
-                    axis.append(ax)
-                    dims.append(dim)
-
-            da = da.expand_dims(dims, axis=axis)
-
-            out = da.isel(selection).values
-
-            # horrible workaround for the crazy CDS / MARS convention to return
-            # a short request at the start of a dataset (at least on ERA5 and ERA5 Land)
-            if self.time_dim in indices and indices[self.time_dim] == 0:
-                if isinstance(self.chunks[self.time_dim], int):
-                    time_chunk = self.chunks[self.time_dim]
-                else:
-                    time_chunk = self.chunks[self.time_dim][0]  # type: ignore
-                if da.coords[self.time_dim].size < time_chunk:
-                    expected_time_dim_size = self.chunks[self.time_dim]
-                    assert isinstance(expected_time_dim_size, int)
-                    fixed = np.empty((expected_time_dim_size,) + out.shape[1:])
-                    offset = fixed.shape[0] - out.shape[0]
-                    fixed[offset:] = out
-                    fixed[:offset] = np.nan
-                    out = fixed
-
-            return out
+        chunks_requests = self.get_chunk_requests(key)
+        out = np.empty(self.get_out_shape(key), dtype=self.dtype)
+
+        def retrieve(
+            chunk_request: tuple[dict[str, Any], dict[str, Any], Any, dict[str, int]],
+        ) -> None:
+            field_request, selection, out_key, indices = chunk_request
+            out[out_key] = self.retrieve_chunk_values(
+                field_request, selection, indices, dataset_cacher
+            )
+
+        if len(chunks_requests) == 1:
+            retrieve(chunks_requests[0])
+        elif len(chunks_requests) > 1:
+            # NOTE: keep all the jobs in flight, not only the ones of the threads
+            dataset_cacher.prefetch([request for request, *_ in chunks_requests])
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+                # NOTE: consume the iterator to raise the exceptions, if any
+                list(executor.map(retrieve, chunks_requests))
+        return out
+
+
+def as_slice(indices: np.typing.NDArray[Any]) -> slice | np.typing.NDArray[Any]:
+    if indices.size == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    steps = np.diff(indices)
+    if indices.size > 1 and steps[0] > 0 and (steps == steps[0]).all():
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(steps[0]))
+    return indices
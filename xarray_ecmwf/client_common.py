@@ -1,10 +1,36 @@
-import calendar
-from typing import Any, ContextManager, Protocol
-
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, ContextManager, Iterable, Iterator, Protocol
+
+import attrs
 import numpy as np
 import pandas as pd
+import requests
 import xarray as xr
 
+LOGGER = logging.getLogger(__name__)
+
+KeyType = int | slice | np.typing.NDArray[np.integer[Any]]
+
+
+class RequestTooLargeError(Exception):
+    pass
+
+
+class RequestThrottledError(Exception):
+    pass
+
+
+# fragments of the error messages of the services when they throttle the requests
+THROTTLING_MESSAGES = ("too many requests", "rate limit", "try again later")
+
 
 class RequestClientProtocol(Protocol):
     def __init__(self, client_kwargs: dict[str, Any]) -> None:
@@ -20,6 +46,26 @@ class RequestClientProtocol(Protocol):
         ...
 
 
+class AsyncRequestClientProtocol(RequestClientProtocol, Protocol):
+    # submit a job without waiting for it and return a handle to it
+    def submit(self, request: dict[str, Any]) -> Any:
+        ...
+
+    # return the result to download when the job is done, None while it runs
+    def poll(self, job: Any) -> Any:
+        ...
+
+
+class ResumableRequestClientProtocol(AsyncRequestClientProtocol, Protocol):
+    # identifier of a submitted job that survives the process
+    def get_job_id(self, job: Any) -> str:
+        ...
+
+    # return a handle to an already submitted job
+    def attach(self, job_id: str) -> Any:
+        ...
+
+
 class DatasetCacherProtocol(Protocol):
     def retrieve(
         self, request: dict[str, Any], override_cache_file: bool | None = None
@@ -31,9 +77,26 @@ class DatasetCacherProtocol(Protocol):
     ) -> ContextManager[xr.Dataset]:
         ...
 
+    def retrieve_values(
+        self,
+        request: dict[str, Any],
+        name: str,
+        selector: Callable[[xr.Dataset], xr.DataArray],
+        selection: dict[str, Any],
+    ) -> np.typing.NDArray[Any]:
+        ...
+
+    def prefetch(self, requests: list[dict[str, Any]]) -> None:
+        ...
+
 
 class RequestChunkerProtocol(Protocol):
-    def __init__(self, request: dict[str, Any], request_chunks: dict[str, Any]) -> None:
+    # names of the variables that `get_variables_coords_attrs_and_dtype` skipped
+    failed_variables: list[str]
+
+    def __init__(
+        self, request: dict[str, Any], request_chunks: dict[str, Any] | str
+    ) -> None:
         ...
 
     def get_request_dimensions(self) -> dict[str, list[Any]]:
@@ -47,15 +110,330 @@ class RequestChunkerProtocol(Protocol):
     def get_variables(self) -> dict[str, "RequestChunkerProtocol"]:
         ...
 
+    def get_variables_coords_attrs_and_dtype(
+        self, dataset_cacher: DatasetCacherProtocol, drop_variables: Iterable[str] = ()
+    ) -> list[
+        tuple[
+            "RequestChunkerProtocol",
+            tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any],
+        ]
+    ]:
+        ...
+
     def get_chunks(self) -> dict[str, int | tuple[int, ...]]:
         ...
 
+    # JSON serializable keyword arguments that rebuild the chunker
+    def get_manifest(self) -> dict[str, Any]:
+        ...
+
+    # restore the state of `get_coords_attrs_and_dtype` from its return value
+    def restore_var_def(
+        self, var_def: tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any]
+    ) -> None:
+        ...
+
     def get_chunk_values(
-        self, key: tuple[int | slice, ...], dataset_cacher: DatasetCacherProtocol
+        self, key: tuple[KeyType, ...], dataset_cacher: DatasetCacherProtocol
     ) -> np.typing.ArrayLike:
         ...
 
 
+def intern_request_fragment(fragment: dict[str, Any]) -> dict[str, Any]:
+    # NOTE: the same values repeat across thousands of chunks, e.g. years and months
+    interned: dict[str, Any] = {}
+    for key, value in fragment.items():
+        if isinstance(value, str):
+            value = sys.intern(value)
+        elif isinstance(value, list):
+            value = [sys.intern(v) if isinstance(v, str) else v for v in value]
+        interned[sys.intern(key)] = value
+    return interned
+
+
+@attrs.frozen(eq=False)
+class ChunkPlan:
+    # chunks along one dimension: where each one starts, how long it is and the
+    # request fragment that retrieves it. Immutable so threads can share it
+    starts: np.typing.NDArray[np.int64]
+    sizes: np.typing.NDArray[np.int64]
+    fragments: tuple[dict[str, Any], ...]
+
+    @classmethod
+    def from_chunk_requests(
+        cls, chunk_requests: list[tuple[int, dict[str, Any]]], size: int
+    ) -> "ChunkPlan":
+        starts = np.array([start for start, _ in chunk_requests], dtype="int64")
+        sizes = np.diff(starts, append=size)
+        starts.flags.writeable = False
+        sizes.flags.writeable = False
+        fragments = tuple(intern_request_fragment(f) for _, f in chunk_requests)
+        return cls(starts, sizes, fragments)
+
+    def __len__(self) -> int:
+        return len(self.fragments)
+
+    def find_chunks(self, indices: Any) -> np.typing.NDArray[np.intp]:
+        chunk_indices: np.typing.NDArray[np.intp]
+        chunk_indices = np.searchsorted(self.starts, indices, side="right") - 1
+        return chunk_indices
+
+
+# keys that do not change the data returned by the services
+IGNORED_REQUEST_KEYS = {"download_format"}
+# keys where the order of the values is significant
+ORDERED_REQUEST_KEYS = {"area", "grid"}
+
+
+def normalize_request_value(key: str, value: Any) -> str:
+    text = str(value).strip()
+    if key == "time" and text.replace(":", "").isdigit():
+        # "00:00", "0000", "0" and 0 are all midnight and "12" is "12:00"
+        hhmm = text.replace(":", "")
+        return str(int(hhmm) * 100 if len(hhmm) <= 2 else int(hhmm))
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    if number.is_integer():
+        return str(int(number))
+    return str(number)
+
+
+def canonical_request(request: dict[str, Any]) -> dict[str, Any]:
+    canonical: dict[str, Any] = {}
+    for key in sorted(request):
+        if key in IGNORED_REQUEST_KEYS:
+            continue
+        value = request[key]
+        if isinstance(value, dict):
+            canonical[key] = canonical_request(value)
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        values = [normalize_request_value(key, v) for v in value]
+        if key not in ORDERED_REQUEST_KEYS:
+            values = sorted(set(values))
+        canonical[key] = values
+    return canonical
+
+
+def request_hash(request: dict[str, Any]) -> str:
+    canonical = canonical_request(request)
+    return hashlib.md5(str(canonical).encode("utf-8")).hexdigest()
+
+
+# keys that may be served by slicing a cached request with more values
+SUBSET_REQUEST_KEYS = {
+    "date",
+    "year",
+    "month",
+    "day",
+    "time",
+    "step",
+    "leadtime_hour",
+    "pressure_level",
+    "levelist",
+    "number",
+}
+SUBSET_COORDS = {
+    "step": "step",
+    "leadtime_hour": "step",
+    "pressure_level": "isobaricInhPa",
+    "levelist": "isobaricInhPa",
+    "number": "number",
+}
+
+
+def expand_dates(values: list[str], sep: str = "/") -> set[str]:
+    dates: set[str] = set()
+    for value in values:
+        if sep in value:
+            start, stop = value.split(sep)
+            dates.update(str(d.date()) for d in pd.date_range(start, stop))
+        else:
+            dates.add(value)
+    return dates
+
+
+def request_covers(superset: dict[str, Any], subset: dict[str, Any]) -> bool:
+    # both requests must be canonical, see `canonical_request`
+    if set(superset) != set(subset):
+        return False
+    for key, values in subset.items():
+        if key == "date":
+            if not expand_dates(values) <= expand_dates(superset[key]):
+                return False
+        elif key in SUBSET_REQUEST_KEYS:
+            if not set(values) <= set(superset[key]):
+                return False
+        elif values != superset[key]:
+            return False
+    return True
+
+
+def subset_dataset(ds: xr.Dataset, request: dict[str, Any]) -> xr.Dataset | None:
+    # select the `request` from a dataset retrieved for a request that covers it,
+    # return None if the dataset does not contain all the values of the request
+    canonical = canonical_request(request)
+    indexers: dict[str, Any] = {}
+    for key, coord in SUBSET_COORDS.items():
+        if key not in canonical or coord not in ds.dims:
+            continue
+        if coord == "step":
+            values = np.array(canonical[key], dtype="timedelta64[h]")
+        else:
+            values = np.array(canonical[key], dtype=ds[coord].dtype)
+        indexers[coord] = (np.flatnonzero(np.isin(ds[coord].values, values)), values)
+
+    if "time" in ds.dims and "time" in canonical:
+        time_request = {
+            "time": [f"{int(t) // 100:02}:{int(t) % 100:02}" for t in canonical["time"]]
+        }
+        if "date" in canonical:
+            if len(canonical["date"]) != 1:
+                return None
+            date = canonical["date"][0]
+            time_request["date"] = [date if "/" in date else f"{date}/{date}"]
+        elif "year" in canonical:
+            time_request["year"] = [f"{int(y):04}" for y in canonical["year"]]
+            time_request["month"] = [f"{int(m):02}" for m in canonical.get("month", [])]
+            time_request["day"] = [f"{int(d):02}" for d in canonical.get("day", [])]
+        else:
+            return None
+        if "year" in time_request:
+            # NOTE: the canonical days are sorted as text, so skip all invalid days
+            dates, valid = build_ymd_dates(time_request, skip_invalid_days=True)
+            values = build_datetimes(dates[valid], time_request["time"])
+        else:
+            values = build_time_chunk_requests(time_request, {})[0]
+        indexers["time"] = (np.flatnonzero(np.isin(ds["time"].values, values)), values)
+
+    isel_kwargs: dict[str, Any] = {}
+    for coord, (indices, values) in indexers.items():
+        if indices.size != values.size:
+            return None
+        # NOTE: mimic cfgrib that squeezes the dimensions of size 1
+        isel_kwargs[coord] = indices[0] if indices.size == 1 else indices
+    return ds.isel(isel_kwargs)
+
+
+def request_value_sort_key(key: str, value: Any) -> tuple[int, float, str]:
+    text = normalize_request_value(key, value)
+    try:
+        return (0, float(text), "")
+    except ValueError:
+        return (1, 0.0, text)
+
+
+def merge_date_ranges(
+    first: list[str], second: list[str], sep: str = "/"
+) -> list[str] | None:
+    if len(first) != 1 or len(second) != 1:
+        return None
+    ranges = []
+    for value in first + second:
+        start_str, _, stop_str = value.partition(sep)
+        ranges.append((pd.Timestamp(start_str), pd.Timestamp(stop_str or start_str)))
+    (first_start, first_stop), (second_start, second_stop) = sorted(ranges)
+    if second_start > first_stop + pd.Timedelta(1, "D"):
+        return None
+    stop = max(first_stop, second_stop)
+    return [f"{first_start.date()}{sep}{stop.date()}"]
+
+
+def merge_requests(
+    first: dict[str, Any], second: dict[str, Any], sep: str = "/"
+) -> dict[str, Any] | None:
+    # a request covering both, if it is possible to get it from the union of the
+    # values of a single key, see `subset_dataset` to select them back
+    if set(first) != set(second):
+        return None
+    values = {
+        key: [v if isinstance(v, list) else [v] for v in (first[key], second[key])]
+        for key in first
+    }
+    differing = [key for key, (a, b) in values.items() if a != b]
+    if not differing:
+        return first
+    if len(differing) > 1 or differing[0] not in SUBSET_REQUEST_KEYS:
+        return None
+    key = differing[0]
+    first_values, second_values = values[key]
+    if key == "date":
+        dates = merge_date_ranges(first_values, second_values, sep)
+        return None if dates is None else first | {key: dates}
+    merged = first_values + [v for v in second_values if v not in first_values]
+    merged.sort(key=lambda value: request_value_sort_key(key, value))
+    return first | {key: merged}
+
+
+def coalesce_requests(
+    requests: list[dict[str, Any]], max_requests: int
+) -> list[tuple[dict[str, Any], list[int]]]:
+    # groups of at most `max_requests` requests and the request covering each group
+    order = sorted(
+        range(len(requests)), key=lambda i: str(canonical_request(requests[i]))
+    )
+    groups: list[tuple[dict[str, Any], list[int]]] = []
+    for index in order:
+        if groups and len(groups[-1][1]) < max_requests:
+            merged = merge_requests(groups[-1][0], requests[index])
+            if merged is not None:
+                groups[-1][1].append(index)
+                groups[-1] = (merged, groups[-1][1])
+                continue
+        groups.append((requests[index], [index]))
+    return groups
+
+
+# keys that may be split when a request is too large and the dimension where the
+# pieces are concatenated, the keys with more values are split first
+SPLIT_REQUEST_KEYS = {
+    "number": "number",
+    "pressure_level": "isobaricInhPa",
+    "levelist": "isobaricInhPa",
+    "date": "time",
+    "year": "time",
+    "month": "time",
+    "day": "time",
+    "step": "step",
+    "leadtime_hour": "step",
+}
+# NOTE: cfgrib sorts the coordinates in ascending order except for the levels
+DESCENDING_COORDS = {"isobaricInhPa"}
+
+
+def split_request(
+    request: dict[str, Any], sep: str = "/"
+) -> tuple[str, list[dict[str, Any]]] | None:
+    # split `request` in two along the key with the most values, returns the
+    # dimension to concatenate the pieces along and the pieces
+    sizes = {}
+    for key in SPLIT_REQUEST_KEYS:
+        values = request.get(key)
+        if not isinstance(values, list):
+            continue
+        if key == "date" and len(values) == 1 and sep in values[0]:
+            start, stop = values[0].split(sep)
+            sizes[key] = (pd.Timestamp(stop) - pd.Timestamp(start)).days + 1
+        else:
+            sizes[key] = len(values)
+    if not sizes or max(sizes.values()) < 2:
+        return None
+    key = max(sizes, key=lambda k: sizes[k])
+    values = request[key]
+    if key == "date" and len(values) == 1:
+        start, stop = map(pd.Timestamp, values[0].split(sep))
+        middle = start + pd.Timedelta(sizes[key] // 2 - 1, "D")
+        first = f"{start.date()}{sep}{middle.date()}"
+        second = f"{(middle + pd.Timedelta(1, 'D')).date()}{sep}{stop.date()}"
+        pieces = [[first], [second]]
+    else:
+        pieces = [values[: len(values) // 2], values[len(values) // 2 :]]
+    return SPLIT_REQUEST_KEYS[key], [request | {key: piece} for piece in pieces]
+
+
 def build_chunks_header_requests(
     dim: str,
     request: dict[str, Any],
@@ -75,68 +453,105 @@ def build_chunks_header_requests(
     return coord, request_chunks_dim, chunk_requests
 
 
+def build_time_offsets(times: list[str]) -> np.typing.NDArray[np.timedelta64]:
+    for time_str in times:
+        assert len(time_str) == 5
+    midnight = np.datetime64("1970-01-01T00:00", "m")
+    datetimes = [f"1970-01-01T{time_str}" for time_str in times]
+    return np.array(datetimes, "datetime64[m]") - midnight
+
+
+def build_datetimes(
+    dates: np.typing.NDArray[np.datetime64], times: list[str]
+) -> np.typing.NDArray[np.datetime64]:
+    # all the `times` of every date, date major as in the requests
+    datetimes = dates.astype("datetime64[m]")[:, None] + build_time_offsets(times)
+    return datetimes.ravel().astype("datetime64[ns]")
+
+
+def build_ymd_dates(
+    request: dict[str, Any], skip_invalid_days: bool = False
+) -> tuple[np.typing.NDArray[np.datetime64], np.typing.NDArray[np.bool_]]:
+    # the dates of the year-month-day grid of the request and the mask of the valid
+    # ones, the days after an invalid day of a month are invalid unless skipped
+    for year in request["year"]:
+        assert len(year) == 4
+    for month in request["month"]:
+        assert len(month) == 2
+    for day in request["day"]:
+        assert len(day) == 2
+    years = np.array(request["year"], dtype="int64")
+    months = np.array(request["month"], dtype="int64")
+    days = np.array(request["day"], dtype="int64")
+    if np.any((months < 1) | (months > 12)):
+        raise ValueError(f"invalid month in {request['month']}")
+
+    month_starts = (
+        ((years[:, None] - 1970) * 12 + months[None, :] - 1)
+        .ravel()
+        .astype("datetime64[M]")
+    )
+    ndays = (month_starts + 1).astype("datetime64[D]") - month_starts.astype(
+        "datetime64[D]"
+    )
+    valid = (days[None, :] >= 1) & (days[None, :] <= ndays.astype("int64")[:, None])
+    if not skip_invalid_days:
+        valid = np.logical_and.accumulate(valid, axis=1)
+    dates = month_starts.astype("datetime64[D]")[:, None] + (days - 1)
+    return dates, valid
+
+
 def build_chunk_date_requests(
     request: dict[str, Any], request_chunks: dict[str, int], sep: str = "/"
-) -> tuple[np.typing.NDArray[np.datetime64], int, list[tuple[int, dict[str, Any]]]]:
-    assert set(request_chunks).intersection(["month", "day", "year"]) <= {"day"}
+) -> tuple[
+    np.typing.NDArray[np.datetime64],
+    int | tuple[int, ...],
+    list[tuple[int, dict[str, Any]]],
+]:
+    time_chunk_keys = set(request_chunks).intersection(["month", "day", "year"])
+    assert len(time_chunk_keys) <= 1
 
     date_start_str, date_stop_str = request["date"][0].split(sep)
-    date_stop = pd.to_datetime(date_stop_str)
+    date_start = pd.to_datetime(date_start_str).to_datetime64().astype("datetime64[D]")
+    date_stop = pd.to_datetime(date_stop_str).to_datetime64().astype("datetime64[D]")
     chunk_days = request_chunks.get("day", 1)
-    timedelta_days = pd.Timedelta(f"{chunk_days}D")
+    ntimes = len(request["time"])
+
+    dates = np.arange(date_start, date_stop + 1, dtype="datetime64[D]")
+    times = build_datetimes(dates, request["time"])
+
+    # the index of the chunk of every date, months and years follow the calendar
+    if "month" in time_chunk_keys:
+        months = dates.astype("datetime64[M]").astype("int64")
+        groups = (months - months[:1]) // request_chunks["month"]
+    elif "year" in time_chunk_keys:
+        years = dates.astype("datetime64[Y]").astype("int64")
+        groups = (years - years[:1]) // request_chunks["year"]
+    else:
+        groups = np.arange(dates.size) // chunk_days
 
-    times: list[np.datetime64] = []
     chunk_requests: list[tuple[int, dict[str, Any]]] = []
-    start = None
-
-    for date in pd.date_range(date_start_str, date_stop_str):
-        if "day" in request_chunks and (
-            start is None or date - timedelta_days == start
-        ):
-            start, stop = (
-                date,
-                min(date + timedelta_days - pd.Timedelta(1, "d"), date_stop),
-            )
-            chunk_requests.append(
-                (
-                    len(times),
-                    {"date": f"{start.date()}{sep}{stop.date()}"},
-                )
-            )
-
-        for time in request["time"]:
-            assert len(time) == 5
-            try:
-                datetime = np.datetime64(f"{date.date()}T{time}", "ns")
-            except ValueError as ex:
-                print(ex)
-                break
-            times.append(datetime)
+    time_chunk: int | tuple[int, ...] = ntimes * chunk_days
+    if time_chunk_keys:
+        starts = np.flatnonzero(np.diff(groups, prepend=-1)).tolist()
+        stops = starts[1:] + [dates.size]
+        for start, stop in zip(starts, stops):
+            fragment = {"date": f"{dates[start]}{sep}{dates[stop - 1]}"}
+            chunk_requests.append((start * ntimes, fragment))
+        if "day" not in time_chunk_keys:
+            time_chunk = tuple((np.subtract(stops, starts) * ntimes).tolist())
 
     if len(chunk_requests) == 0:
         chunk_requests = [(0, {})]
 
-    return np.array(times), len(request["time"]) * chunk_days, chunk_requests
+    return times, time_chunk, chunk_requests
 
 
 def build_ymd_coordinates_request(
     request: dict[str, Any],
 ) -> np.typing.NDArray[np.datetime64]:
-    times: list[np.datetime64] = []
-    for year in request["year"]:
-        assert len(year) == 4
-        for month in request["month"]:
-            assert len(month) == 2
-            ndays = calendar.monthrange(int(year), int(month))[1]
-            for day in request["day"]:
-                assert len(day) == 2
-                if int(day) > ndays:
-                    break
-                for time in request["time"]:
-                    assert len(time) == 5
-                    datetime = np.datetime64(f"{year}-{month}-{day}T{time}", "ns")
-                    times.append(datetime)
-    return np.array(times)
+    dates, valid = build_ymd_dates(request)
+    return build_datetimes(dates[valid], request["time"])
 
 
 def build_chunk_ymd_month_requests(
@@ -146,34 +561,64 @@ def build_chunk_ymd_month_requests(
     int | tuple[int, ...],
     list[tuple[int, dict[str, Any]]],
 ]:
-    if request_chunks["month"] != 1:
-        raise ValueError("split on day values != 1 not supported")
-
-    datetimes: list[np.datetime64] = []
+    chunk_months = request_chunks["month"]
+    dates, valid = build_ymd_dates(request)
+    ntimes = len(request["time"])
+    nmonths = len(request["month"])
+    month_ndays = valid.sum(axis=1).tolist()
+
+    # NOTE: a chunk never spans two years, so it can be requested as a product
+    #   of one year, some months and the days of the longest month
     chunk_requests = []
     chunks = []
-    for year in request["year"]:
-        assert len(year) == 4
-        for month in request["month"]:
-            chunk = 0
-            assert len(month) == 2
-            ndays = calendar.monthrange(int(year), int(month))[1]
-            start = len(datetimes)
-            days = []
-            for day in request["day"]:
-                assert len(day) == 2
-                if int(day) > ndays:
-                    break
-                days.append(day)
-                for time in request["time"]:
-                    assert len(time) == 5
-                    chunk += 1
-                    datetime = np.datetime64(f"{year}-{month}-{day}T{time}", "ns")
-                    datetimes.append(datetime)
-            chunks.append(chunk)
+    start = 0
+    for year_index, year in enumerate(request["year"]):
+        for month_index in range(0, nmonths, chunk_months):
+            months = request["month"][month_index : month_index + chunk_months]
+            row = year_index * nmonths + month_index
+            ndays = month_ndays[row : row + len(months)]
+            days = request["day"][: max(ndays)]
+            fragment = {
+                "year": year,
+                "month": months[0] if chunk_months == 1 else months,
+                "day": days,
+            }
+            chunk_requests.append((start, fragment))
+            chunks.append(sum(ndays) * ntimes)
+            start += chunks[-1]
+    return build_datetimes(dates[valid], request["time"]), tuple(chunks), chunk_requests
+
+
+def build_chunk_ymd_year_requests(
+    request: dict[str, Any], request_chunks: dict[str, int]
+) -> tuple[
+    np.typing.NDArray[np.datetime64],
+    int | tuple[int, ...],
+    list[tuple[int, dict[str, Any]]],
+]:
+    chunk_years = request_chunks["year"]
+    dates, valid = build_ymd_dates(request)
+    ntimes = len(request["time"])
+    year_ndays = valid.reshape(len(request["year"]), -1).sum(axis=1).tolist()
+    max_ndays = valid.sum(axis=1).reshape(len(request["year"]), -1).max(axis=1)
 
-            chunk_requests.append((start, {"year": year, "month": month, "day": days}))
-    return np.array(datetimes), tuple(chunks), chunk_requests
+    chunk_requests = []
+    chunks = []
+    start = 0
+    for year_index in range(0, len(request["year"]), chunk_years):
+        years = request["year"][year_index : year_index + chunk_years]
+        days = request["day"][
+            : int(max_ndays[year_index : year_index + chunk_years].max())
+        ]
+        fragment = {
+            "year": years[0] if chunk_years == 1 else years,
+            "month": request["month"],
+            "day": days,
+        }
+        chunk_requests.append((start, fragment))
+        chunks.append(sum(year_ndays[year_index : year_index + chunk_years]) * ntimes)
+        start += chunks[-1]
+    return build_datetimes(dates[valid], request["time"]), tuple(chunks), chunk_requests
 
 
 def build_chunk_ymd_requests(
@@ -189,9 +634,12 @@ def build_chunk_ymd_requests(
 
     assert len(time_chunk_keys) == 1
     time_chunk_key = time_chunk_keys[0]
-    assert time_chunk_key in set(["day", "month"])
+    if request_chunks[time_chunk_key] < 1:
+        raise ValueError(f"invalid {time_chunk_key} chunks {request_chunks}")
 
-    if time_chunk_key == "month":
+    if time_chunk_key == "year":
+        out = build_chunk_ymd_year_requests(request, request_chunks)
+    elif time_chunk_key == "month":
         out = build_chunk_ymd_month_requests(request, request_chunks)
     elif time_chunk_key == "day":
         out = build_chunk_ymd_day_requests(request, request_chunks)
@@ -200,34 +648,39 @@ def build_chunk_ymd_requests(
 
 def build_chunk_ymd_day_requests(
     request: dict[str, Any], request_chunks: dict[str, int]
-) -> tuple[np.typing.NDArray[np.datetime64], int, list[tuple[int, dict[str, Any]]]]:
-    if request_chunks["day"] != 1:
-        raise ValueError("split on day values != 1 not supported")
-
-    times: list[np.datetime64] = []
+) -> tuple[
+    np.typing.NDArray[np.datetime64],
+    int | tuple[int, ...],
+    list[tuple[int, dict[str, Any]]],
+]:
+    chunk_days = request_chunks["day"]
+    # NOTE: days that do not exist in a month, e.g. 31 in April, are skipped
+    dates, valid = build_ymd_dates(request, skip_invalid_days=True)
+    ntimes = len(request["time"])
+    times = build_datetimes(dates[valid], request["time"])
+
+    if chunk_days == 1:
+        ymd = itertools.product(request["year"], request["month"], request["day"])
+        valid_ymd = itertools.compress(ymd, valid.ravel().tolist())
+        chunk_requests = [
+            (index * ntimes, {"year": year, "month": month, "day": day})
+            for index, (year, month, day) in enumerate(valid_ymd)
+        ]
+        return times, ntimes, chunk_requests
+
+    # NOTE: a chunk never spans two months, so it can be requested as a product
     chunk_requests = []
-    for year in request["year"]:
-        assert len(year) == 4
-        for month in request["month"]:
-            assert len(month) == 2
-            for day in request["day"]:
-                start = len(times)
-                assert len(day) == 2
-                for time in request["time"]:
-                    assert len(time) == 5
-                    try:
-                        datetime = np.datetime64(f"{year}-{month}-{day}T{time}", "ns")
-                    except ValueError:
-                        break
-                    times.append(datetime)
-                else:
-                    if request_chunks["day"] != 1:
-                        raise ValueError("split on day values != 1 not supported")
-                    chunk_requests.append(
-                        (start, {"year": year, "month": month, "day": day})
-                    )
-
-    return np.array(times), len(request["time"]), chunk_requests
+    chunks = []
+    start = 0
+    ym = itertools.product(request["year"], request["month"])
+    for (year, month), month_valid in zip(ym, valid.tolist()):
+        days = list(itertools.compress(request["day"], month_valid))
+        for day_index in range(0, len(days), chunk_days):
+            chunk = days[day_index : day_index + chunk_days]
+            chunk_requests.append((start, {"year": year, "month": month, "day": chunk}))
+            chunks.append(len(chunk) * ntimes)
+            start += chunks[-1]
+    return times, tuple(chunks), chunk_requests
 
 
 def build_time_chunk_requests(
@@ -249,3 +702,257 @@ def build_time_chunk_requests(
         raise ValueError("request must contain either 'year' or 'date'")
 
     return time, time_chunk, time_chunk_requests
+
+
+def is_throttling_error(ex: BaseException) -> bool:
+    if isinstance(ex, RequestThrottledError):
+        return True
+    response = getattr(ex, "response", None)
+    if getattr(response, "status_code", None) in (429, 503):
+        return True
+    message = str(ex).lower()
+    return any(fragment in message for fragment in THROTTLING_MESSAGES)
+
+
+def wake_up(waiter: asyncio.Future[None]) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+@attrs.define(slots=False)
+class AdaptiveLimiter:
+    # limit on the number of concurrent operations with additive increase and
+    # multiplicative decrease: the limit grows by about `increase` per round of
+    # successful operations and is multiplied by `decrease` on throttling errors
+    limit: float = 4.0
+    min_limit: float = 1.0
+    max_limit: float = 32.0
+    increase: float = 1.0
+    decrease: float = 0.5
+
+    def __attrs_post_init__(self) -> None:
+        self.active = 0
+        self.condition = threading.Condition()
+        # futures of the coroutines waiting for a slot and their event loops
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = []
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        args = (self.limit, self.min_limit, self.max_limit, self.increase)
+        return (AdaptiveLimiter, args + (self.decrease,))
+
+    def try_acquire(self) -> bool:
+        with self.condition:
+            if self.active >= int(self.limit):
+                return False
+            self.active += 1
+            return True
+
+    def acquire(self) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+
+    async def acquire_async(self) -> None:
+        # NOTE: the limiter is shared by threads and event loops so the waiters are
+        # woken up by `release` and compete again for the free slots
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.active < int(self.limit):
+                    self.active += 1
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, ex: BaseException | None = None) -> None:
+        # other errors than throttling say nothing about the service capacity
+        with self.condition:
+            self.active -= 1
+            if ex is None:
+                limit = self.limit + self.increase / self.limit
+                self.limit = min(self.max_limit, limit)
+            elif is_throttling_error(ex):
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            self.condition.notify_all()
+            for loop, waiter in self.waiters:
+                with contextlib.suppress(RuntimeError):
+                    loop.call_soon_threadsafe(wake_up, waiter)
+            self.waiters.clear()
+
+
+# initial and maximum limits of the concurrent operations by client type,
+# "submit" counts the jobs from submission to completion
+SERVICE_LIMITS: dict[str, dict[str, dict[str, float]]] = {
+    "CdsapiRequestClient": {
+        "submit": {"limit": 4, "max_limit": 32},
+        "download": {"limit": 2, "max_limit": 8},
+    },
+    "PolytopeRequestClient": {
+        "submit": {"limit": 1, "max_limit": 8},
+        "download": {"limit": 1, "max_limit": 4},
+    },
+}
+DEFAULT_SERVICE_LIMITS = {
+    "submit": {"limit": 4, "max_limit": 32},
+    "download": {"limit": 4, "max_limit": 16},
+}
+SERVICE_LIMITERS: dict[tuple[str, str, str], AdaptiveLimiter] = {}
+SERVICE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_service_limiter(request_client: Any, operation: str) -> AdaptiveLimiter:
+    # the limiters are shared by all the clients of a type and endpoint
+    client_type = type(request_client).__name__
+    get_endpoint = getattr(request_client, "get_endpoint", None)
+    endpoint = get_endpoint() if get_endpoint is not None else ""
+    key = (client_type, endpoint, operation)
+    with SERVICE_LIMITERS_LOCK:
+        if key not in SERVICE_LIMITERS:
+            limits = SERVICE_LIMITS.get(client_type, DEFAULT_SERVICE_LIMITS)
+            SERVICE_LIMITERS[key] = AdaptiveLimiter(**limits[operation])
+        return SERVICE_LIMITERS[key]
+
+
+def reset_service_limiters() -> None:
+    # NOTE: the operations counted by the limiters belong to the parent process
+    global SERVICE_LIMITERS_LOCK
+    SERVICE_LIMITERS.clear()
+    SERVICE_LIMITERS_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_service_limiters)
+
+
+@attrs.define(slots=False)
+class ClientPool:
+    # idle service clients by their keyword arguments, so that the configuration,
+    # the authentication and the HTTP sessions with their open connections are
+    # reused across requests. A client is used by one thread at a time
+    factory: Callable[..., Any]
+    max_idle: int = 8
+
+    def __attrs_post_init__(self) -> None:
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle: dict[str, list[Any]] = {}
+
+    @contextlib.contextmanager
+    def client(self, **kwargs: Any) -> Iterator[Any]:
+        # NOTE: the keyword arguments may hold unhashable values
+        key = repr(sorted(kwargs.items()))
+        if self.pid != os.getpid():
+            # the sessions of the parent process must not be shared with a child
+            self.__attrs_post_init__()
+        with self.lock:
+            idle = self.idle.get(key)
+            client = idle.pop() if idle else None
+        if client is None:
+            client = self.factory(**kwargs)
+        # NOTE: a client that raised is not returned to the pool
+        yield client
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(client)
+
+
+# errors of an interrupted transfer, the download is resumed from where it stopped
+INTERRUPTED_DOWNLOAD_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+# multihash prefixes of the supported checksums
+MULTIHASH_PREFIXES = {"d50110": "md5", "1220": "sha256", "1340": "sha512"}
+
+
+def parse_multihash(multihash: str | None) -> tuple[str, str] | None:
+    # e.g. the "file:checksum" of the STAC assets of the CDS results
+    for prefix, algorithm in MULTIHASH_PREFIXES.items():
+        if multihash is not None and multihash.startswith(prefix):
+            return (algorithm, multihash[len(prefix) :])
+    return None
+
+
+def file_checksum(path: str, algorithm: str, chunk_size: int = 2**24) -> str:
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while data := f.read(chunk_size):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def download_with_resume(
+    url: str,
+    target: str,
+    size: int | None = None,
+    checksum: tuple[str, str] | None = None,
+    session: Any = None,
+    max_retries: int = 10,
+    retry_after: float = 10.0,
+    timeout: float = 60.0,
+    chunk_size: int = 2**16,
+) -> str:
+    # NOTE: the partial file is named after the URL and survives the failures so
+    # that later attempts, also by other processes, resume the transfer with HTTP
+    # Range requests. Retries are counted only when no data was transferred and
+    # at most `chunk_size` bytes received before a failure are lost
+    url_hash = hashlib.md5(url.encode("utf-8")).hexdigest()
+    partial_path = os.path.join(os.path.dirname(target), url_hash + ".partial")
+    if session is None:
+        session = requests.Session()
+    retries = 0
+    while True:
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if size is not None and offset >= size:
+            break
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as res:
+                if res.status_code == 416:
+                    # the partial file is already complete
+                    break
+                res.raise_for_status()
+                if res.status_code != 206:
+                    # the server ignores the range
+                    offset = 0
+                content_length = res.headers.get("Content-Length")
+                if size is None and content_length is not None:
+                    size = offset + int(content_length)
+                with open(partial_path, "ab" if offset else "wb") as f:
+                    for data in res.iter_content(chunk_size):
+                        f.write(data)
+            if size is None:
+                break
+            error: Exception = RuntimeError(f"connection closed early: {url}")
+        except INTERRUPTED_DOWNLOAD_ERRORS as ex:
+            error = ex
+        except Exception:
+            # NOTE: e.g. an expired URL, the partial file could never be resumed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial_path)
+            raise
+        downloaded = (
+            os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        )
+        if size is not None and downloaded >= size:
+            break
+        retries = 0 if downloaded > offset else retries + 1
+        if retries > max_retries:
+            raise error
+        LOGGER.info(f"resuming the download of {url} at {downloaded}: {error!r}")
+        time.sleep(retry_after * retries)
+
+    downloaded = os.path.getsize(partial_path)
+    if size is not None and downloaded != size:
+        os.remove(partial_path)
+        raise RuntimeError(f"downloaded {downloaded} bytes out of {size}: {url}")
+    if checksum is not None:
+        algorithm, expected = checksum
+        actual = file_checksum(partial_path, algorithm)
+        if actual != expected:
+            os.remove(partial_path)
+            raise RuntimeError(f"{algorithm} checksum {actual} != {expected}: {url}")
+    os.replace(partial_path, target)
+    return target
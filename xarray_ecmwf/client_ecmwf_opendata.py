@@ -1,25 +1,35 @@
-import hashlib
 import logging
 from typing import Any
 
 import attrs
 import ecmwf.opendata
 
+from . import client_common
+
 LOGGER = logging.getLogger(__name__)
 
+CLIENT_POOL = client_common.ClientPool(ecmwf.opendata.Client)
+
 
 @attrs.define
 class EcmwfOpendataRequestClient:
     client_kwargs: dict[str, Any] = {}
 
     def submit_and_wait_on_result(self, request: dict[str, Any]) -> Any:
-        target = hashlib.md5(str(request).encode("utf-8")).hexdigest() + ".grib"
+        target = client_common.request_hash(request) + ".grib"
         return {"request": request.copy(), "target": target}
 
+    def submit(self, request: dict[str, Any]) -> Any:
+        # NOTE: the open data files are ready, there is nothing to wait for
+        return self.submit_and_wait_on_result(request)
+
+    def poll(self, job: Any) -> Any:
+        return job
+
     def get_filename(self, result: Any) -> str:
         return result["target"]  # type: ignore
 
     def download(self, result: Any, target: str | None = None) -> str:
         source = result["request"].pop("source", "ecmwf")
-        client = ecmwf.opendata.Client(source=source, **self.client_kwargs)
-        return client.retrieve(request=result["request"], target=target)  # type: ignore
+        with CLIENT_POOL.client(source=source, **self.client_kwargs) as client:
+            return client.retrieve(request=result["request"], target=target)  # type: ignore
@@ -1,17 +1,40 @@
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
 import functools
+import glob
 import hashlib
+import json
 import logging
 import os
+import shutil
 import socket
+import threading
+import time
 import uuid
-from typing import Any, Callable, Iterable, Iterator, Sequence
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    Sequence,
+    cast,
+)
 
 import attrs
 import numpy as np
 import xarray as xr
 
-from . import client_cdsapi, client_common, client_ecmwf_opendata, client_polytope
+from . import (
+    __version__,
+    client_cdsapi,
+    client_common,
+    client_ecmwf_opendata,
+    client_polytope,
+)
 
 LOGGER = logging.getLogger(__name__)
 HOSTNAME = socket.gethostname()
@@ -41,12 +64,14 @@ class ECMWFBackendArray(xr.backends.BackendArray):
         data = xr.core.indexing.explicit_indexing_adapter(
             key,
             self.shape,
-            xr.core.indexing.IndexingSupport.BASIC,
+            xr.core.indexing.IndexingSupport.OUTER,
             self._raw_indexing_method,
         )
         return data  # type: ignore
 
-    def _raw_indexing_method(self, key: tuple[int | slice, ...]) -> np.typing.ArrayLike:
+    def _raw_indexing_method(
+        self, key: tuple[client_common.KeyType, ...]
+    ) -> np.typing.ArrayLike:
         out = self.request_chunker.get_chunk_values(key, self.dataset_cacher)
         return out
 
@@ -68,12 +93,757 @@ def robust_save_to_file(
     os.rename(tmp_path, path)
 
 
+def get_size(path: str) -> int:
+    if not os.path.isdir(path):
+        return os.stat(path).st_size
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            with contextlib.suppress(FileNotFoundError):
+                size += os.stat(os.path.join(root, file)).st_size
+    return size
+
+
+# name, coords, dataset attrs, variable attrs and dtype of a variable
+VarDefType = tuple[str, dict[str, Any], dict[str, Any], dict[str, Any], Any]
+
+
+def save_manifest(
+    var_defs: list[tuple[client_common.RequestChunkerProtocol, VarDefType]], path: str
+) -> None:
+    # NOTE: the manifest is plain data, a zarr group by variable, as unlike pickles
+    #   it is safe to load from a cache folder shared with other users
+    for index, (request_chunker, var_def) in enumerate(var_defs):
+        name, coords, ds_attrs, var_attrs, dtype = var_def
+        manifest = {
+            "name": name,
+            "dims": list(coords),
+            "request_chunker": request_chunker.get_manifest(),
+        }
+        data_vars = {
+            "__dataset__": xr.Variable((), np.zeros((), "int8"), ds_attrs),
+            "__variable__": xr.Variable((), np.zeros((), dtype), var_attrs),
+        }
+        ds = xr.Dataset(data_vars, coords, {"manifest": json.dumps(manifest)})
+        ds.to_zarr(path, group=str(index), mode="a", consolidated=False)
+
+
+def load_manifest(
+    path: str, request_chunker_class: type[client_common.RequestChunkerProtocol]
+) -> list[tuple[client_common.RequestChunkerProtocol, VarDefType]]:
+    var_defs = []
+    groups = sorted(int(name) for name in os.listdir(path) if name.isdigit())
+    for group in groups:
+        with xr.open_dataset(
+            path, engine="zarr", group=str(group), consolidated=False
+        ) as ds:
+            ds.load()
+        manifest = json.loads(ds.attrs["manifest"])
+        coords = {dim: ds.coords[dim] for dim in manifest["dims"]}
+        var = ds["__variable__"]
+        var_def = (
+            manifest["name"],
+            coords,
+            ds["__dataset__"].attrs,
+            var.attrs,
+            var.dtype,
+        )
+        request_chunker = request_chunker_class(**manifest["request_chunker"])
+        request_chunker.restore_var_def(var_def)
+        var_defs.append((request_chunker, var_def))
+    return var_defs
+
+
+def save_json(obj: Any, path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(obj, f)
+
+
+def load_json(path: str) -> Any:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def json_items(kwargs: dict[str, Any]) -> dict[str, Any]:
+    # NOTE: e.g. a lock in the kwargs would change the key of every call
+    items = {}
+    for key, value in kwargs.items():
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        items[key] = value
+    return items
+
+
+def save_job_entry(entry: dict[str, Any], path: str) -> None:
+    robust_save_to_file(save_json, (entry,), path)
+
+
+@attrs.define(slots=False)
+class FileLease:
+    # lock shared by processes and hosts accessing the same folder, e.g. on NFS.
+    # The holder refreshes the lease file and a lease older than `timeout` seconds
+    # is considered left over by a dead process and is broken
+    path: str
+    timeout: float = 300.0
+    poll_interval: float = 1.0
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self.token = f"{HOSTNAME} {os.getpid()} {uuid.uuid4()}"
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    stat = os.stat(self.path)
+                except FileNotFoundError:
+                    continue
+                if time.time() - stat.st_mtime > self.timeout:
+                    self.break_stale(stat)
+                elif not blocking:
+                    return False
+                else:
+                    time.sleep(self.poll_interval)
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.token)
+            break
+        self.released = threading.Event()
+        self.refresher = threading.Thread(target=self.refresh, daemon=True)
+        self.refresher.start()
+        return True
+
+    def break_stale(self, stat: os.stat_result) -> None:
+        # NOTE: another waiter may have broken the lease and taken a fresh one after
+        #   `stat`, so move it away first and check that it is the stale one
+        moved_path = f"{self.path}.stale-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(self.path, moved_path)
+        except FileNotFoundError:
+            return
+        moved_stat = os.stat(moved_path)
+        if (moved_stat.st_ino, moved_stat.st_mtime) == (stat.st_ino, stat.st_mtime):
+            LOGGER.warning(f"breaking stale lease {self.path}")
+            os.remove(moved_path)
+        else:
+            self.put_back(moved_path)
+
+    def put_back(self, moved_path: str) -> None:
+        # NOTE: a link, unlike a rename, never replaces a lease taken in the meantime
+        try:
+            os.link(moved_path, self.path)
+        except FileExistsError:
+            LOGGER.warning(f"lease {self.path} taken while moved away")
+        os.remove(moved_path)
+
+    def is_owned(self, path: str) -> bool:
+        try:
+            with open(path) as f:
+                return f.read() == self.token
+        except FileNotFoundError:
+            return False
+
+    def refresh(self) -> None:
+        while not self.released.wait(self.timeout / 4):
+            if not self.is_owned(self.path):
+                LOGGER.warning(f"lease {self.path} was broken")
+                return
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self.path)
+
+    def release(self) -> None:
+        self.released.set()
+        self.refresher.join()
+        # NOTE: only remove the lease if it was not broken and taken by another
+        moved_path = f"{self.path}.released-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(self.path, moved_path)
+        except FileNotFoundError:
+            return
+        if self.is_owned(moved_path):
+            os.remove(moved_path)
+        else:
+            self.put_back(moved_path)
+
+    def __enter__(self) -> "FileLease":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.release()
+
+
+@attrs.define(slots=False)
+class ArrayCache:
+    max_bytes: int
+
+    def __attrs_post_init__(self) -> None:
+        self.variables: collections.OrderedDict[
+            Any, xr.Variable
+        ] = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # NOTE: the cache is local to the process, do not send its content around
+        return (ArrayCache, (self.max_bytes,))
+
+    def get(self, key: Any) -> xr.Variable | None:
+        with self.lock:
+            variable = self.variables.get(key)
+            if variable is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.variables.move_to_end(key)
+            return variable
+
+    def put(self, key: Any, variable: xr.Variable) -> None:
+        if variable.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.variables:
+                return
+            self.variables[key] = variable
+            self.nbytes += variable.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.variables.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+@attrs.define(slots=False)
+class DatasetPool:
+    max_size: int
+
+    def __attrs_post_init__(self) -> None:
+        self.datasets: collections.OrderedDict[
+            str, xr.Dataset
+        ] = collections.OrderedDict()
+        self.users: collections.Counter[str] = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # NOTE: open files are local to the process, do not send them around
+        return (DatasetPool, (self.max_size,))
+
+    def discard(self, path: str) -> None:
+        with self.lock:
+            if path in self.datasets and self.users[path] == 0:
+                del self.users[path]
+                self.datasets.pop(path).close()
+
+    def close_unused(self) -> None:
+        # NOTE: must be called with the lock held
+        for path in list(self.datasets):
+            if len(self.datasets) <= self.max_size:
+                break
+            if self.users[path] == 0:
+                del self.users[path]
+                self.datasets.pop(path).close()
+
+    @contextlib.contextmanager
+    def open(
+        self, path: str, open_dataset: Callable[[str], xr.Dataset]
+    ) -> Iterator[xr.Dataset]:
+        with self.lock:
+            ds = self.datasets.get(path)
+            if ds is not None:
+                self.datasets.move_to_end(path)
+                self.users[path] += 1
+        if ds is None:
+            new_ds = open_dataset(path)
+            with self.lock:
+                ds = self.datasets.setdefault(path, new_ds)
+                self.datasets.move_to_end(path)
+                self.users[path] += 1
+            if ds is not new_ds:
+                new_ds.close()
+        try:
+            yield ds
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                self.close_unused()
+
+
+@attrs.define(slots=False)
+class JobScheduler:
+    # keeps the jobs submitted to the services in flight in an asyncio event loop
+    # running in a background thread, polls them in batches every `poll_interval`
+    # seconds and downloads the results with a pool of `max_downloads` threads.
+    # The jobs of resumable clients are recorded in a `job_path` JSON file so that
+    # a new process re-attaches to them instead of submitting them again.
+    # The jobs and the downloads of each service are further limited by the
+    # adaptive limiters of client_common.get_service_limiter and the operations
+    # throttled by the service are retried up to `max_throttled_retries` times
+    max_jobs: int = 32
+    poll_interval: float = 5.0
+    max_downloads: int = 16
+    max_throttled_retries: int = 5
+
+    def __attrs_post_init__(self) -> None:
+        self.pid = os.getpid()
+        self.futures: dict[str, concurrent.futures.Future[None]] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.lock = threading.RLock()
+        # the jobs to poll with the number of their consecutive throttled polls
+        self.polled: list[tuple[Any, Any, asyncio.Future[Any], int]] = []
+        self.poller: asyncio.Task[None] | None = None
+        self.semaphore = asyncio.Semaphore(self.max_jobs)
+        self.download_pool = concurrent.futures.ThreadPoolExecutor(self.max_downloads)
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # NOTE: the event loop and the jobs are local to the process
+        args = (self.max_jobs, self.poll_interval, self.max_downloads)
+        return (get_job_scheduler, args + (self.max_throttled_retries,))
+
+    def schedule(
+        self,
+        key: str,
+        request_client: client_common.RequestClientProtocol,
+        request: dict[str, Any],
+        save: Callable[[Any], None],
+        job_path: str | None = None,
+    ) -> concurrent.futures.Future[None]:
+        # the jobs are identified by `key` so a job in flight is never submitted again
+        self.check_process()
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                return future
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                thread.start()
+            coroutine = self.run_job(request_client, request, save, job_path)
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+            self.futures[key] = future
+            future.add_done_callback(functools.partial(self.forget, key))
+        return future
+
+    def check_process(self) -> None:
+        # NOTE: a forked child inherits the scheduler but not its event loop thread
+        if self.pid != os.getpid():
+            self.__attrs_post_init__()
+
+    def forget(self, key: str, future: concurrent.futures.Future[None]) -> None:
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+
+    def wait(self, key: str) -> None:
+        self.check_process()
+        with self.lock:
+            future = self.futures.get(key)
+        if future is not None:
+            # NOTE: the failures are raised again by the caller retrieving it
+            with contextlib.suppress(Exception):
+                future.result()
+
+    async def run_job(
+        self,
+        request_client: client_common.RequestClientProtocol,
+        request: dict[str, Any],
+        save: Callable[[Any], None],
+        job_path: str | None = None,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        submit_limiter = client_common.get_service_limiter(request_client, "submit")
+        download_limiter = client_common.get_service_limiter(request_client, "download")
+
+        async def submit() -> Any:
+            if hasattr(request_client, "submit") and hasattr(request_client, "poll"):
+                async_client = cast(
+                    client_common.AsyncRequestClientProtocol, request_client
+                )
+                resumable_job_path = job_path
+                if not hasattr(request_client, "attach"):
+                    resumable_job_path = None
+                return await self.submit_and_poll(
+                    async_client, request, resumable_job_path
+                )
+            submit_and_wait = request_client.submit_and_wait_on_result
+            return await loop.run_in_executor(None, submit_and_wait, request)
+
+        async def download() -> None:
+            await loop.run_in_executor(self.download_pool, save, result)
+
+        async with self.semaphore:
+            result = await self.run_limited(submit_limiter, submit)
+        await self.run_limited(download_limiter, download)
+        if job_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(job_path)
+
+    async def run_limited(
+        self,
+        limiter: client_common.AdaptiveLimiter,
+        operation: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        for attempt in range(self.max_throttled_retries + 1):
+            await limiter.acquire_async()
+            try:
+                result = await operation()
+            except Exception as ex:
+                limiter.release(ex)
+                throttled = client_common.is_throttling_error(ex)
+                if not throttled or attempt == self.max_throttled_retries:
+                    raise
+                LOGGER.info(f"throttled by the service, retrying: {ex!r}")
+                await asyncio.sleep(self.poll_interval * 2**attempt)
+            else:
+                limiter.release()
+                return result
+
+    async def submit_and_poll(
+        self,
+        request_client: client_common.AsyncRequestClientProtocol,
+        request: dict[str, Any],
+        job_path: str | None,
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        if job_path is None:
+            job = await loop.run_in_executor(None, request_client.submit, request)
+            return await self.wait_on_job(request_client, job)
+
+        resumable_client = cast(
+            client_common.ResumableRequestClientProtocol, request_client
+        )
+        canonical = client_common.canonical_request(request)
+        entry = await loop.run_in_executor(None, load_json, job_path)
+        if entry is not None and entry.get("request") == canonical:
+            job_id = entry["job_id"]
+            LOGGER.info(f"re-attaching to job {job_id} in state {entry['state']}")
+            try:
+                job = await loop.run_in_executor(None, resumable_client.attach, job_id)
+                return await self.wait_on_job(resumable_client, job)
+            except Exception as ex:
+                # NOTE: e.g. the job expired or was deleted on the service
+                LOGGER.warning(f"cannot re-attach to job {job_id}: {ex!r}")
+
+        job = await loop.run_in_executor(None, resumable_client.submit, request)
+        job_id = resumable_client.get_job_id(job)
+        entry = {"request": canonical, "job_id": job_id, "state": "submitted"}
+        await loop.run_in_executor(None, save_job_entry, entry, job_path)
+        result = await self.wait_on_job(resumable_client, job)
+        entry["state"] = "completed"
+        await loop.run_in_executor(None, save_job_entry, entry, job_path)
+        return result
+
+    async def wait_on_job(
+        self, request_client: client_common.AsyncRequestClientProtocol, job: Any
+    ) -> Any:
+        # NOTE: poll once right away, e.g. open data jobs are ready on submit
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(None, request_client.poll, job)
+        except Exception as ex:
+            if not client_common.is_throttling_error(ex):
+                raise
+            result = None
+        if result is not None:
+            return result
+        future = loop.create_future()
+        self.polled.append((request_client, job, future, 0))
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.create_task(self.poll_jobs())
+        return await future
+
+    async def poll_jobs(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self.polled:
+            await asyncio.sleep(self.poll_interval)
+            polled, self.polled = self.polled, []
+            results = await asyncio.gather(
+                *(loop.run_in_executor(None, c.poll, job) for c, job, *_ in polled),
+                return_exceptions=True,
+            )
+            for (request_client, job, future, throttled), result in zip(
+                polled, results
+            ):
+                # NOTE: only the throttled poll is retried, never the submit
+                if (
+                    isinstance(result, Exception)
+                    and client_common.is_throttling_error(result)
+                    and throttled < self.max_throttled_retries
+                ):
+                    LOGGER.info(f"poll throttled by the service: {result!r}")
+                    self.polled.append((request_client, job, future, throttled + 1))
+                elif isinstance(result, BaseException):
+                    future.set_exception(result)
+                elif result is None:
+                    self.polled.append((request_client, job, future, 0))
+                else:
+                    future.set_result(result)
+
+
+JOB_SCHEDULERS: dict[tuple[Any, ...], JobScheduler] = {}
+JOB_SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_job_scheduler(*args: Any) -> JobScheduler:
+    # NOTE: one scheduler per process, and per settings, shared by all the cachers
+    with JOB_SCHEDULERS_LOCK:
+        if args not in JOB_SCHEDULERS:
+            JOB_SCHEDULERS[args] = JobScheduler(*args)
+        return JOB_SCHEDULERS[args]
+
+
+def reset_job_schedulers() -> None:
+    global JOB_SCHEDULERS_LOCK
+    JOB_SCHEDULERS.clear()
+    JOB_SCHEDULERS_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_job_schedulers)
+
+
+@attrs.define(slots=False)
+class RequestCoalescer:
+    # collects the requests arriving within `window` seconds and retrieves the
+    # compatible ones as a single request of at most `max_requests` of them
+    window: float
+    max_requests: int = 8
+    max_workers: int = 4
+
+    def __attrs_post_init__(self) -> None:
+        self.pending: list[tuple[dict[str, Any], threading.Event]] = []
+        self.collecting = False
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (RequestCoalescer, (self.window, self.max_requests, self.max_workers))
+
+    def retrieve_group(
+        self,
+        merged_request: dict[str, Any],
+        events: list[threading.Event],
+        retrieve: Callable[[dict[str, Any]], None],
+    ) -> None:
+        try:
+            retrieve(merged_request)
+        except Exception:
+            # NOTE: the requests are retrieved one by one as a fallback
+            LOGGER.exception(f"failed to retrieve coalesced {merged_request}")
+        finally:
+            for event in events:
+                event.set()
+
+    def wait(
+        self, request: dict[str, Any], retrieve: Callable[[dict[str, Any]], None]
+    ) -> None:
+        # returns when the request is ready to be served from a coalesced request
+        # or it needs to be retrieved on its own
+        event = threading.Event()
+        with self.lock:
+            self.pending.append((request, event))
+            is_leader = not self.collecting
+            self.collecting = True
+        if not is_leader:
+            event.wait()
+            return
+
+        time.sleep(self.window)
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.collecting = False
+        requests = [pending_request for pending_request, _ in pending]
+        for merged_request, indices in client_common.coalesce_requests(
+            requests, self.max_requests
+        ):
+            events = [pending[index][1] for index in indices]
+            if len(indices) == 1:
+                events[0].set()
+                continue
+            LOGGER.info(f"coalesced {len(indices)} requests in {merged_request}")
+            self.executor.submit(self.retrieve_group, merged_request, events, retrieve)
+        event.wait()
+
+
 @attrs.define(slots=False)
 class DatasetCacher:
     request_client: client_common.RequestClientProtocol
     open_dataset: Callable[..., xr.Dataset] = xr.open_dataset
     cache_file: bool = True
     cache_folder: str = "./.xarray-ecmwf-cache"
+    cache_only: bool = False
+    cache_manifest: bool = True
+    # maximum size in bytes of the decoded chunks kept in memory, 0 disables it
+    memory_cache_size: int = 0
+    # maximum number of cached files kept open, 0 disables it
+    max_open_datasets: int = 32
+    # lease timeout of the file locks shared with other processes, 0 disables them
+    lease_timeout: float = 300.0
+    # limits of the cache_folder content, the least recently used files are evicted
+    # first and the ones used in the last `min_cache_age` seconds are kept, 0 means
+    # no limit
+    max_cache_size: int = 0
+    max_cache_files: int = 0
+    min_cache_age: float = 60.0
+    # serve a request missing from the cache by slicing a cached file whose request
+    # covers it, e.g. one day out of a cached month
+    serve_from_supersets: bool = True
+    # split the requests rejected as too large by the service and concatenate the
+    # pieces, retrieved with at most `max_split_workers` threads
+    split_large_requests: bool = True
+    max_split_workers: int = 4
+    # merge the chunk requests arriving within `coalesce_window` seconds that
+    # differ only in one key, e.g. consecutive days, 0 disables it
+    coalesce_window: float = 0.0
+    max_coalesced_requests: int = 8
+    # maximum number of jobs in flight on the service, the interval in seconds
+    # between the checks of their status and the number of parallel downloads,
+    # see JobScheduler
+    max_jobs: int = 32
+    poll_interval: float = 5.0
+    max_downloads: int = 16
+    # record the submitted jobs in the cache folder and re-attach to them
+    resume_jobs: bool = True
+
+    def __attrs_post_init__(self) -> None:
+        self.array_cache = ArrayCache(self.memory_cache_size)
+        self.dataset_pool = DatasetPool(self.max_open_datasets)
+        # canonical requests of the cached files by path of their request file
+        self.superset_index: dict[str, dict[str, Any]] = {}
+        # sizes of the zarr stores of the cache by path, see `list_cache_entries`
+        self.store_sizes: dict[str, int] = {}
+        self.request_coalescer = RequestCoalescer(
+            self.coalesce_window, self.max_coalesced_requests
+        )
+        self.job_scheduler = get_job_scheduler(
+            self.max_jobs, self.poll_interval, self.max_downloads
+        )
+
+    def cache_path(self, request: dict[str, Any], suffix: str = ".grib") -> str:
+        filename = client_common.request_hash(request) + suffix
+        return os.path.join(self.cache_folder, filename)
+
+    def job_path(self, path: str, cache_file: bool) -> str | None:
+        # NOTE: the jobs of temporary files are not worth resuming
+        if not cache_file or not self.resume_jobs:
+            return None
+        return path + ".job"
+
+    def file_lock(self, path: str) -> ContextManager[Any]:
+        if self.lease_timeout <= 0:
+            return contextlib.nullcontext()
+        return FileLease(path + ".lock", self.lease_timeout)
+
+    def touch(self, path: str) -> None:
+        # NOTE: the modification time records the last use as atime is unreliable
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+
+    def remove_cache_entry(
+        self, path: str, idx_paths: Iterable[str] | None = None
+    ) -> bool:
+        # NOTE: rename first so that other processes never see a partial entry
+        evicted_path = path + ".evicted-" + str(uuid.uuid4())[:8]
+        try:
+            os.rename(path, evicted_path)
+        except FileNotFoundError:
+            return False
+        self.dataset_pool.discard(path)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + ".json")
+        if os.path.isdir(evicted_path):
+            shutil.rmtree(evicted_path, ignore_errors=True)
+        else:
+            os.remove(evicted_path)
+        self.store_sizes.pop(path, None)
+        # remove the associated cfgrib index files
+        if idx_paths is None:
+            idx_paths = glob.glob(glob.escape(path) + "*.idx")
+        for idx_path in idx_paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(idx_path)
+        return True
+
+    def list_cache_entries(
+        self,
+    ) -> tuple[list[tuple[float, int, str]], dict[str, list[str]], set[str]]:
+        # NOTE: a single listing of the folder, also for the cfgrib index files and
+        #   the lock files. The zarr stores are written once so their sizes are kept
+        stats: dict[str, tuple[float, int]] = {}
+        idx_paths: dict[str, list[str]] = collections.defaultdict(list)
+        idx_sizes: dict[str, int] = collections.defaultdict(int)
+        locked = set()
+        try:
+            dir_entries = list(os.scandir(self.cache_folder))
+        except FileNotFoundError:
+            dir_entries = []
+        for dir_entry in dir_entries:
+            name, path = dir_entry.name, dir_entry.path
+            try:
+                if name.endswith(".idx"):
+                    # e.g. <hash>.grib.<index hash>.idx
+                    grib_name, sep, _ = name.partition(".grib")
+                    grib_path = os.path.join(self.cache_folder, grib_name + sep)
+                    idx_paths[grib_path].append(path)
+                    idx_sizes[grib_path] += dir_entry.stat().st_size
+                elif name.endswith(".lock"):
+                    locked.add(path[: -len(".lock")])
+                elif name.endswith(".grib"):
+                    stat = dir_entry.stat()
+                    stats[path] = (stat.st_mtime, stat.st_size)
+                elif name.endswith(".zarr"):
+                    if path not in self.store_sizes:
+                        self.store_sizes[path] = get_size(path)
+                    stats[path] = (dir_entry.stat().st_mtime, self.store_sizes[path])
+            except FileNotFoundError:
+                continue
+        entries = [
+            (mtime, size + idx_sizes.get(path, 0), path)
+            for path, (mtime, size) in stats.items()
+        ]
+        return entries, idx_paths, locked
+
+    def evict_cache(self) -> None:
+        if self.max_cache_size <= 0 and self.max_cache_files <= 0:
+            return
+        entries, idx_paths, locked = self.list_cache_entries()
+        entries.sort()
+
+        cache_size = sum(size for _, size, _ in entries)
+        cache_files = len(entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if (self.max_cache_size <= 0 or cache_size <= self.max_cache_size) and (
+                self.max_cache_files <= 0 or cache_files <= self.max_cache_files
+            ):
+                break
+            if now - mtime < self.min_cache_age or path in locked:
+                continue
+            LOGGER.info(f"evicting cache file {path}")
+            if self.remove_cache_entry(path, idx_paths.get(path, [])):
+                cache_size -= size
+                cache_files -= 1
+
+    def find_superset(self, request: dict[str, Any]) -> str | None:
+        canonical = client_common.canonical_request(request)
+        pattern = os.path.join(glob.escape(self.cache_folder), "*.grib.json")
+        for request_path in glob.glob(pattern):
+            superset = self.superset_index.get(request_path)
+            if superset is None:
+                try:
+                    with open(request_path) as f:
+                        superset = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    continue
+                self.superset_index[request_path] = superset
+            path = request_path[: -len(".json")]
+            if client_common.request_covers(superset, canonical) and os.path.exists(
+                path
+            ):
+                return path
+        return None
 
     @contextlib.contextmanager
     def retrieve(
@@ -82,16 +852,64 @@ class DatasetCacher:
         override_cache_file: bool | None = None,
         tries: int = 2,
     ) -> Iterator[xr.Dataset]:
+        # NOTE: the pieces of a request known to be too large are retrieved directly
+        split_path = self.cache_path(request, suffix=".split")
+        if self.split_large_requests and os.path.exists(split_path):
+            with open(split_path) as f:
+                dim, sub_requests = json.load(f)
+            with self.retrieve_split(dim, sub_requests, override_cache_file) as ds:
+                yield ds
+            return
+
+        split = None
         for try_ in range(tries):
             try:
                 with self.retrieve_once(request, override_cache_file) as ds:
                     yield ds
                 break
+            except client_common.RequestTooLargeError:
+                split = client_common.split_request(request)
+                if not self.split_large_requests or split is None:
+                    raise
+                LOGGER.info(f"splitting the request too large {request}")
+                break
             except RuntimeError:
                 LOGGER.exception(f"Failed retrieve: {try_} / {tries}")
         else:
             raise RuntimeError(f"too many retries {tries}")
 
+        if split is not None:
+            dim, sub_requests = split
+            if self.cache_file:
+                robust_save_to_file(save_json, ([dim, sub_requests],), split_path)
+            with self.retrieve_split(dim, sub_requests, override_cache_file) as ds:
+                yield ds
+
+    @contextlib.contextmanager
+    def retrieve_split(
+        self,
+        dim: str,
+        sub_requests: list[dict[str, Any]],
+        override_cache_file: bool | None = None,
+    ) -> Iterator[xr.Dataset]:
+        with contextlib.ExitStack() as stack:
+
+            def retrieve(sub_request: dict[str, Any]) -> xr.Dataset:
+                # NOTE: the pieces are split again if they are still too large
+                context = self.retrieve(sub_request, override_cache_file)
+                return stack.enter_context(context).load()
+
+            with concurrent.futures.ThreadPoolExecutor(
+                self.max_split_workers
+            ) as executor:
+                datasets = list(executor.map(retrieve, sub_requests))
+            ds = xr.concat(datasets, dim, combine_attrs="override")
+            # NOTE: the chunks are read by position, so sort as in an unsplit file
+            if dim in ds.coords:
+                ascending = dim not in client_common.DESCENDING_COORDS
+                ds = ds.sortby(dim, ascending=ascending)
+            yield ds
+
     @contextlib.contextmanager
     def retrieve_once(
         self, request: dict[str, Any], override_cache_file: bool | None = None
@@ -101,20 +919,57 @@ class DatasetCacher:
         if override_cache_file is not None:
             cache_file = override_cache_file
 
-        result = self.request_client.submit_and_wait_on_result(request)
-        filename = self.request_client.get_filename(result)
-        path = os.path.join(self.cache_folder, filename)
+        path = self.cache_path(request)
+        if not cache_file:
+            # NOTE: the file is removed after use so it must not be shared
+            path += "." + str(uuid.uuid4())[:8]
 
         if not os.path.isdir(self.cache_folder):
             os.makedirs(self.cache_folder, exist_ok=True)
 
-        with xr.backends.locks.get_write_lock(f"{HOSTNAME}-grib"):  # type: ignore
-            if not os.path.exists(path):
-                robust_save_to_file(self.request_client.download, (result,), path)
-        ds = self.open_dataset(path)
-        LOGGER.debug("request: %r ->\n%r", request, list(ds.data_vars.values())[0])
+        superset_path = None
+        if cache_file and self.serve_from_supersets and not os.path.exists(path):
+            superset_path = self.find_superset(request)
+        if superset_path is not None:
+            with self.dataset_pool.open(superset_path, self.open_dataset) as ds:
+                subset_ds = client_common.subset_dataset(ds, request)
+                if subset_ds is not None:
+                    LOGGER.info(f"serving {request} from {superset_path}")
+                    self.touch(superset_path)
+                    yield subset_ds
+                    return
+
+        # NOTE: a cache hit is served without any round trip to the service
+        if not os.path.exists(path):
+            if self.cache_only:
+                raise FileNotFoundError(f"request not found in cache: {request}")
+            self.job_scheduler.wait(path)
+            # NOTE: lock on the file so that different files are downloaded in
+            #   parallel and concurrent requests for the same file wait for one
+            lock_name = f"{HOSTNAME}-grib-{os.path.basename(path)}"
+            with xr.backends.locks.get_write_lock(lock_name):  # type: ignore
+                with self.file_lock(path):
+                    if not os.path.exists(path):
+                        save = functools.partial(
+                            self.save_result, request, path, cache_file
+                        )
+                        job_path = self.job_path(path, cache_file)
+                        self.job_scheduler.schedule(
+                            path, self.request_client, request, save, job_path
+                        ).result()
+        elif cache_file:
+            self.touch(path)
+        open_context: ContextManager[xr.Dataset]
+        if cache_file:
+            open_context = self.dataset_pool.open(path, self.open_dataset)
+        else:
+            open_context = contextlib.nullcontext(self.open_dataset(path))
         try:
-            yield ds
+            with open_context as ds:
+                LOGGER.debug(
+                    "request: %r ->\n%r", request, list(ds.data_vars.values())[0]
+                )
+                yield ds
         finally:
             if not cache_file:
                 try:
@@ -127,14 +982,127 @@ class DatasetCacher:
                 except Exception:
                     LOGGER.exception("While removing a cache file")
 
+    def save_result(
+        self, request: dict[str, Any], path: str, cache_file: bool, result: Any
+    ) -> None:
+        robust_save_to_file(self.request_client.download, (result,), path)
+        if cache_file:
+            canonical = client_common.canonical_request(request)
+            robust_save_to_file(save_json, (canonical,), path + ".json")
+        self.evict_cache()
+
+    def prefetch(self, requests: list[dict[str, Any]]) -> None:
+        # start the jobs of the requests missing from the cache without waiting,
+        # `retrieve` then waits for them
+        if not self.cache_file or self.cache_only:
+            return
+        if self.coalesce_window > 0:
+            groups = client_common.coalesce_requests(
+                requests, self.max_coalesced_requests
+            )
+            requests = [merged_request for merged_request, _ in groups]
+        if not os.path.isdir(self.cache_folder):
+            os.makedirs(self.cache_folder, exist_ok=True)
+        for request in requests:
+            path = self.cache_path(request)
+            if os.path.exists(path):
+                continue
+            if self.serve_from_supersets and self.find_superset(request) is not None:
+                continue
+            lease = None
+            if self.lease_timeout > 0:
+                # NOTE: skip the requests that another process is retrieving
+                lease = FileLease(path + ".lock", self.lease_timeout)
+                if not lease.acquire(blocking=False):
+                    continue
+                if os.path.exists(path):
+                    lease.release()
+                    continue
+            save = functools.partial(self.save_result, request, path, True)
+            future = self.job_scheduler.schedule(
+                path, self.request_client, request, save, self.job_path(path, True)
+            )
+            future.add_done_callback(functools.partial(self.prefetched, lease))
+
+    def prefetched(
+        self, lease: FileLease | None, future: concurrent.futures.Future[None]
+    ) -> None:
+        if lease is not None:
+            lease.release()
+        if future.exception() is not None:
+            LOGGER.warning(f"prefetch failed: {future.exception()!r}")
+
+    def retrieve_values(
+        self,
+        request: dict[str, Any],
+        name: str,
+        selector: Callable[[xr.Dataset], xr.DataArray],
+        selection: dict[str, Any],
+    ) -> np.typing.NDArray[Any]:
+        if self.memory_cache_size <= 0:
+            self.maybe_coalesce(request)
+            with self.retrieve(request) as ds:
+                return selector(ds).isel(selection).values
+
+        key = (self.cache_path(request, suffix=""), name)
+        variable = self.array_cache.get(key)
+        if variable is None:
+            self.maybe_coalesce(request)
+            with self.retrieve(request) as ds:
+                variable = selector(ds).variable.load().to_base_variable()
+            self.array_cache.put(key, variable)
+        return variable.isel(selection).values
+
+    def maybe_coalesce(self, request: dict[str, Any]) -> None:
+        # NOTE: the coalesced request is cached with its request file and the
+        #   requests in it are served from it as a superset
+        if (
+            self.coalesce_window <= 0
+            or not self.cache_file
+            or self.cache_only
+            or not self.serve_from_supersets
+            or os.path.exists(self.cache_path(request))
+            or self.find_superset(request) is not None
+        ):
+            return
+
+        def retrieve(merged_request: dict[str, Any]) -> None:
+            with self.retrieve(merged_request):
+                pass
+
+        self.request_coalescer.wait(request, retrieve)
+
+    def cached_manifest(
+        self,
+        key: dict[str, Any],
+        request_chunker: client_common.RequestChunkerProtocol,
+        drop_variables: Iterable[str] = (),
+    ) -> list[tuple[client_common.RequestChunkerProtocol, VarDefType]]:
+        # NOTE: the order of the request values defines the order of the coordinates
+        #   so the key is not canonicalized. The library version is part of the key
+        #   to invalidate old manifests
+        key = key | {"version": __version__}
+        filename = hashlib.md5(str(key).encode("utf-8")).hexdigest() + ".manifest"
+        path = os.path.join(self.cache_folder, filename)
+        if self.cache_manifest and os.path.exists(path):
+            LOGGER.info(f"loading manifest {path}")
+            return load_manifest(path, type(request_chunker))
+
+        var_defs = request_chunker.get_variables_coords_attrs_and_dtype(
+            self, drop_variables
+        )
+
+        # NOTE: a variable missing because of a transient error is not persisted
+        if self.cache_manifest and not request_chunker.failed_variables:
+            if not os.path.isdir(self.cache_folder):
+                os.makedirs(self.cache_folder, exist_ok=True)
+            robust_save_to_file(save_manifest, (var_defs,), path)
+        return var_defs
+
     @contextlib.contextmanager
     def cached_empty_dataset(self, request: dict[str, Any]) -> Iterator[xr.Dataset]:
         LOGGER.info(f"cached_empty_dataset {request}")
-        request_stable = {k: v for k, v in request.items() if k != "download_format"}
-        filename = (
-            hashlib.md5(str(request_stable).encode("utf-8")).hexdigest() + ".zarr"
-        )
-        path = os.path.join(self.cache_folder, filename)
+        path = self.cache_path(request, suffix=".zarr")
 
         if not os.path.isdir(self.cache_folder):
             os.makedirs(self.cache_folder, exist_ok=True)
@@ -142,12 +1110,21 @@ class DatasetCacher:
         if not os.path.exists(path):
             with self.retrieve(request) as read_ds:
                 # check again as the retrieve may be long
-                with xr.backends.locks.get_write_lock(f"{HOSTNAME}-zarr"):  # type: ignore
-                    if not os.path.exists(path):
-                        # NOTE: be sure that read_ds is chunked so compute=False only
-                        #   writes the metadata. Some open_dataset
-                        read_ds = read_ds.chunk()
-                        read_ds.to_zarr(path, compute=False)
+                lock_name = f"{HOSTNAME}-zarr-{os.path.basename(path)}"
+                with xr.backends.locks.get_write_lock(lock_name):  # type: ignore
+                    with self.file_lock(path):
+                        if not os.path.exists(path):
+                            # NOTE: be sure that read_ds is chunked so compute=False
+                            #   only writes the metadata. Some open_dataset
+                            read_ds = read_ds.chunk()
+                            robust_save_to_file(
+                                functools.partial(read_ds.to_zarr, compute=False),
+                                (),
+                                path,
+                            )
+                            self.evict_cache()
+        else:
+            self.touch(path)
         yield xr.open_dataset(path, engine="zarr")
 
 
@@ -160,7 +1137,7 @@ class ECMWFBackendEntrypoint(xr.backends.BackendEntrypoint):
         client: str = "cdsapi",
         client_kwargs: dict[str, Any] = {},
         chunker: str = "cdsapi",
-        request_chunks: dict[str, Any] = {},
+        request_chunks: dict[str, Any] | str = {},
         cache_kwargs: dict[str, Any] = {},
         open_dataset_kwargs: dict[str, Any] = {},
         request_chunker_kwargs: dict[str, Any] = {},
@@ -184,21 +1161,32 @@ class ECMWFBackendEntrypoint(xr.backends.BackendEntrypoint):
         dataset_cacher = DatasetCacher(request_client, open_dataset, **cache_kwargs)
         LOGGER.info(request_chunker.get_request_dimensions())
 
+        if drop_variables is None:
+            drop_variables = ()
+        elif isinstance(drop_variables, str):
+            drop_variables = [drop_variables]
+        manifest_key = {
+            "request": filename_or_obj,
+            "request_chunks": request_chunks,
+            "chunker": chunker,
+            "request_chunker_kwargs": request_chunker_kwargs,
+            "drop_variables": sorted(drop_variables),
+            # NOTE: the client and the cfgrib options change the variables found
+            "client": client,
+            "client_kwargs": json_items(client_kwargs),
+            "open_dataset_kwargs": json_items(open_dataset_kwargs),
+        }
+        var_defs = dataset_cacher.cached_manifest(
+            manifest_key, request_chunker, drop_variables
+        )
+
         data_vars = {}
-        for var_name, var_request_chunker in request_chunker.get_variables().items():
-            # drop_variables: both on var_name...
-            if drop_variables is not None and var_name in drop_variables:
-                continue
-            try:
-                var_def = var_request_chunker.get_coords_attrs_and_dtype(dataset_cacher)
-                LOGGER.info(f"found  variable {var_name} as {var_def[0]}")
-            except Exception as ex:
-                LOGGER.exception(f"failed to define variable {var_name}")
-                latest_ex = ex
-                continue
+        coords: dict[str, Any] = {}
+        attrs: dict[str, Any] = {}
+        for var_request_chunker, var_def in var_defs:
             name, coords, attrs, var_attrs, dtype = var_def
             # drop_variables: ... and on name
-            if drop_variables is not None and name in drop_variables:
+            if name in drop_variables:
                 continue
             shape = tuple(c.size for c in coords.values())
             dims = list(coords)
@@ -218,8 +1206,5 @@ class ECMWFBackendEntrypoint(xr.backends.BackendEntrypoint):
             var = xr.Variable(dims, lazy_var_data, var_attrs, encoding)
             data_vars[name] = var
 
-        if not data_vars:
-            raise latest_ex
-
         dataset = xr.Dataset(data_vars, coords, attrs)
         return dataset